@@ -1,16 +1,29 @@
 # first written by nandflash("저장장치") <github@printk.info> since 2020-06-25
 
 import socket
+import select
+import array
 import serial
 import paho.mqtt.client as paho_mqtt
 import json
 
 import sys
 import time
+import asyncio
+import heapq
+import itertools
+import collections
+import threading
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os.path
 import re
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows에는 없음, socket 수신량은 select로 대신 확인
+    fcntl = None
 
 ####################
 #VIRTUAL_DEVICE = {
@@ -370,9 +383,15 @@ ACK_MAP = {}
 for device, prop in RS485_DEVICE.items():
     for cmd, code in prop.items():
         if "ack" in code:
-            ACK_MAP[code["id"]] = {}
-            ACK_MAP[code["id"]][code["cmd"]] = {}
-            ACK_MAP[code["id"]][code["cmd"]] = code["ack"]
+            ACK_MAP.setdefault(code["id"], {})[code["cmd"]] = code["ack"]
+
+# 명령 우선순위 (작을수록 먼저 보냄), 같은 순위 안에서는 장치별로 돌아가며 보냄
+COMMAND_PRIORITY = {
+    0x12: 0,    # 가스밸브
+    0x36: 1,    # 난방
+    0x0E: 2,    # 전등
+}
+COMMAND_PRIORITY_DEFAULT = 3
 
 # KTDO: 아래 미사용으로 코멘트 처리
 #HEADER_0_STATE = 0xB0
@@ -395,19 +414,304 @@ header_0_first_candidate = [ [[0x33, 0x01], [0x33, 0x0F]], [[0x36, 0x01], [0x36,
 #virtual_ack = {}
 #virtual_avail = []
 
-serial_queue = {}
+# 보낼 명령 하나의 재시도 상태
+class SerialCommand:
+    def __init__(self, packet, now):
+        self.packet = packet
+        # 장치 id + 그룹(방) 단위로 fairness 관리
+        self.device = packet[1:3]
+        self.priority = COMMAND_PRIORITY.get(packet[1], COMMAND_PRIORITY_DEFAULT)
+
+        # KTDO: Ezville은 4 Byte까지 확인 필요
+        ack = bytearray(packet[0:4])
+        ack[3] = ACK_MAP.get(packet[1], {}).get(packet[3], 0x00)
+        self.waive_ack = ack[3] == 0x00
+        self.ack = int.from_bytes(ack, "big")
+
+        self.queued = now
+        self.deadline = now + Options["rs485"]["max_retry"]
+        self.retries = 0
+        self.done = False
+
+
+# 명령 큐: 우선순위 > 장치별 round-robin 순으로 보내고, 재시도는 간격을 두 배씩 늘림
+class SerialScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = []        # (priority, round, seq, cmd)
+        self._delayed = []      # (next_try, seq, cmd)
+        self._pending = {}      # packet: cmd
+        self._round = {}        # device: 마지막으로 배정한 round
+        self._current_round = 0
+        self._seq = itertools.count()
+
+        self._done = 0
+        self._expired = 0
+        self._retries = 0
+        self._age_sum = 0.0
+        self._age_max = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, packet):
+        now = time.time()
+        with self._lock:
+            cmd = self._pending.get(packet)
+            if cmd:
+                # 같은 명령이 또 들어오면 재시도 기한만 연장
+                cmd.deadline = now + Options["rs485"]["max_retry"]
+                return
+
+            cmd = SerialCommand(packet, now)
+            self._pending[packet] = cmd
+            self._schedule(cmd)
+
+    def _schedule(self, cmd):
+        # 한 장치 명령이 몰려 있어도 다른 장치 명령이 번갈아 나가도록 round를 배정
+        rnd = max(self._round.get(cmd.device, 0), self._current_round) + 1
+        self._round[cmd.device] = rnd
+        heapq.heappush(self._ready, (cmd.priority, rnd, next(self._seq), cmd))
+
+    def _promote(self, now):
+        # 재시도 시간이 된 명령을 보낼 목록으로 옮김
+        while self._delayed and self._delayed[0][0] <= now:
+            cmd = heapq.heappop(self._delayed)[2]
+            if not cmd.done:
+                self._schedule(cmd)
+
+        while self._ready and self._ready[0][3].done:
+            heapq.heappop(self._ready)
+
+    def ready(self):
+        with self._lock:
+            self._promote(time.time())
+            return bool(self._ready)
+
+    def pop(self):
+        # 지금 보낼 명령 하나, 기한이 지난 명령은 버림
+        now = time.time()
+        with self._lock:
+            self._promote(now)
+            while self._ready:
+                _, rnd, _, cmd = heapq.heappop(self._ready)
+                if cmd.done:
+                    continue
+                self._current_round = rnd
+
+                if now > cmd.deadline:
+                    logger.error("send to device:  {} max retry time exceeded! ({} retries)".format(cmd.packet.hex(), cmd.retries))
+                    self._finish(cmd, now, expired=True)
+                    continue
+
+                return cmd
+
+        return None
+
+    def sent(self, cmd):
+        # ack가 안 오면 다시 보낼 시간 예약 (retry_interval 부터 두 배씩, retry_interval_max 까지)
+        now = time.time()
+        with self._lock:
+            if cmd.retries:
+                self._retries += 1
+            cmd.retries += 1
+
+            delay = min(Options["rs485"]["retry_interval"] << (cmd.retries - 1), Options["rs485"]["retry_interval_max"]) / 1000
+            heapq.heappush(self._delayed, (now + delay, next(self._seq), cmd))
+
+    def finish(self, cmd):
+        with self._lock:
+            self._finish(cmd, time.time())
+
+    def _finish(self, cmd, now, expired=False):
+        if cmd.done:
+            return
+        cmd.done = True
+
+        self._pending.pop(cmd.packet, None)
+        if serial_ack.get(cmd.ack) is cmd:
+            serial_ack.pop(cmd.ack)
+
+        if expired:
+            self._expired += 1
+            return
+
+        age = now - cmd.queued
+        self._done += 1
+        self._age_sum += age
+        self._age_max = max(self._age_max, age)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            oldest = min((cmd.queued for cmd in self._pending.values()), default=now)
+            return {
+                "depth": len(self._pending),
+                "oldest_age": round(now - oldest, 3),
+                "done": self._done,
+                "expired": self._expired,
+                "retries": self._retries,
+                "age_avg": round(self._age_sum / self._done, 3) if self._done else 0,
+                "age_max": round(self._age_max, 3),
+            }
+
+
+serial_queue = SerialScheduler()
+SERIAL_STATS_PERIOD = 60
 serial_ack = {}
 
 last_query = int(0).to_bytes(2, "big")
 last_topic_list = {}
 
 mqtt = paho_mqtt.Client()
+
+
+# 상태 publish를 serial 처리와 분리: 쌓아두기만 하고 별도 thread가 로그 출력 및 publish
+class MqttPublisher:
+    def __init__(self, size):
+        self._size = size
+        self._cond = threading.Condition()
+        self._queue = collections.OrderedDict()     # topic: (value, packet, device)
+
+        self._published = 0
+        self._replaced = 0
+        self._dropped = 0
+        self._max_depth = 0
+
+    def start(self):
+        threading.Thread(target=self._worker, name="mqtt_publisher", daemon=True).start()
+
+    def publish(self, topic, value, packet, device):
+        with self._cond:
+            if topic in self._queue:
+                # 아직 못 보낸 이전 값은 버리고 최신 값만 보냄 (순서는 유지)
+                self._replaced += 1
+            elif len(self._queue) >= self._size:
+                # 가득 찼으면 가장 오래된 topic을 버림
+                self._drop(*self._queue.popitem(last=False))
+
+            self._queue[topic] = (value, packet, device)
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._cond.notify()
+
+    def _drop(self, topic, item):
+        _, packet, device = item
+        # 로그도 serial 처리를 늦추므로 여기서는 세기만 함 (주기적으로 통계 출력)
+        self._dropped += 1
+
+        # 같은 상태 패킷이 다시 오면 다시 보내도록 캐시를 비움
+        last_topic_list.pop(topic, None)
+        RS485_DEVICE[device]["last"][(packet[1] << 8) | packet[2]] = True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                topic, (value, packet, device) = self._queue.popitem(last=False)
+
+            logger.info("publish to HA:   {} = {} ({})".format(topic, value, packet.hex()))
+            mqtt.publish(topic, value)
+
+            with self._cond:
+                self._published += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self._max_depth,
+                "published": self._published,
+                "replaced": self._replaced,
+                "dropped": self._dropped,
+            }
+
+
+publisher = None
+
+# asyncio 엔진 사용 시 serial 처리가 돌고 있는 event loop
+serial_event_loop = None
 mqtt_connected = False
 
 logger = logging.getLogger(__name__)
 
+# 수신 데이터를 버퍼에 모아두고 완성된 패킷 단위로 꺼내준다
+class EzVilleFramer:
+    # 한 번에 읽어올 최대 크기
+    RECV_CHUNK = 4096
+
+    def _init_framer(self):
+        self._frame_buf = bytearray()
+        self._frame_pos = 0
+        self._pending_recv = 0
+
+    def _consume(self, count):
+        self._frame_pos += count
+        self._pending_recv = max(self._pending_recv - count, 0)
+
+    def _buffered(self):
+        return len(self._frame_buf) - self._frame_pos
+
+    def fill(self):
+        # 다 쓴 앞부분이 남은 부분보다 커졌을 때만 정리 (memmove 비용을 나눠서 냄)
+        if self._frame_pos and self._frame_pos >= self._buffered():
+            del self._frame_buf[0:self._frame_pos]
+            self._frame_pos = 0
+
+        data = self._recv_chunk()
+        if not data:
+            raise EOFError("connection closed")
+        self._frame_buf.extend(data)
+
+    def next_packet(self):
+        # 버퍼에 완성된 패킷이 있으면 꺼내고, 없으면 None (읽기는 하지 않음)
+        # F7 ID GROUP CMD LEN DATA... XOR ADD
+        buf = self._frame_buf
+        while True:
+            start = buf.find(0xF7, self._frame_pos)
+            if start < 0:
+                self._consume(len(buf) - self._frame_pos)
+                return None
+
+            # 중간에 corrupt되는 data가 있으므로 연속 0xF7은 마지막 것만 사용
+            while start + 1 < len(buf) and buf[start + 1] == 0xF7:
+                start += 1
+            self._consume(start - self._frame_pos)
+
+            if len(buf) - start < 5:
+                return None
+
+            # 데이터 길이 + 7 (헤더 5 + XOR + ADD) 만큼 잘라냄
+            end = start + buf[start + 4] + 7
+            if len(buf) < end:
+                return None
+
+            packet = bytes(buf[start:end])
+
+            # checksum이 안맞으면 F7 다음부터 다시 찾음
+            if not serial_verify_checksum(packet):
+                self._consume(1)
+                continue
+
+            self._consume(end - start)
+            return packet
+
+    def recv_packet(self):
+        # 완성된 패킷이 나올 때까지 읽음
+        while True:
+            packet = self.next_packet()
+            if packet is not None:
+                return packet
+            self.fill()
+
+    def set_pending_recv(self):
+        self._pending_recv = self._buffered() + self._waiting()
+
+    def check_pending_recv(self):
+        return self._pending_recv
+
 # KTDO: 수정 완료
-class EzVilleSerial:
+class EzVilleSerial(EzVilleFramer):
     def __init__(self):
         self._ser = serial.Serial()
         self._ser.port = Options["serial"]["port"]
@@ -419,7 +723,7 @@ class EzVilleSerial:
         self._ser.close()
         self._ser.open()
 
-        self._pending_recv = 0
+        self._init_framer()
 
         # 시리얼에 뭐가 떠다니는지 확인
         self.set_timeout(5.0)
@@ -432,27 +736,29 @@ class EzVilleSerial:
         return self._ser.read(count)
 
     def recv(self, count=1):
-        # serial은 pending count만 업데이트
-        self._pending_recv = max(self._pending_recv - count, 0)
         return self._recv_raw(count)
 
-    def send(self, a):
-        self._ser.write(a)
+    def _recv_chunk(self):
+        # 최소 1 byte는 기다리고, 쌓여있는건 한 번에 가져옴
+        return self._recv_raw(min(max(self._ser.in_waiting, 1), self.RECV_CHUNK))
 
-    def set_pending_recv(self):
-        self._pending_recv = self._ser.in_waiting
+    def _waiting(self):
+        return self._ser.in_waiting
 
-    def check_pending_recv(self):
-        return self._pending_recv
+    def send(self, a):
+        self._ser.write(a)
 
     def check_in_waiting(self):
         return self._ser.in_waiting
 
+    def fileno(self):
+        return self._ser.fileno()
+
     def set_timeout(self, a):
         self._ser.timeout = a
 
 # KTDO: 수정 완료
-class EzVilleSocket:
+class EzVilleSocket(EzVilleFramer):
     def __init__(self):
         addr = Options["socket"]["address"]
         port = Options["socket"]["port"]
@@ -460,8 +766,10 @@ class EzVilleSocket:
         self._soc = socket.socket()
         self._soc.connect((addr, port))
 
-        self._recv_buf = bytearray()
-        self._pending_recv = 0
+        # recv_into용 고정 버퍼, 받은 데이터는 framer 버퍼 하나로만 관리
+        self._chunk = bytearray(self.RECV_CHUNK)
+        self._chunk_view = memoryview(self._chunk)
+        self._init_framer()
 
         # 소켓에 뭐가 떠다니는지 확인
         self.set_timeout(5.0)
@@ -473,34 +781,41 @@ class EzVilleSocket:
     def _recv_raw(self, count=1):
         return self._soc.recv(count)
 
+    def _recv_chunk(self):
+        count = self._soc.recv_into(self._chunk_view)
+        return self._chunk_view[:count]
+
     def recv(self, count=1):
-        # socket은 버퍼와 in_waiting 직접 관리
-        if len(self._recv_buf) < count:
-            new_data = self._recv_raw(256)
-            self._recv_buf.extend(new_data)
-        if len(self._recv_buf) < count:
+        # socket은 framer 버퍼에서 consumed offset만 옮김
+        if self._buffered() < count:
+            try:
+                self.fill()
+            except EOFError:
+                pass
+        if self._buffered() < count:
             return None
 
-        self._pending_recv = max(self._pending_recv - count, 0)
-
-        res = self._recv_buf[0:count]
-        del self._recv_buf[0:count]
+        res = self._frame_buf[self._frame_pos:self._frame_pos + count]
+        self._consume(count)
         return res
 
-    def send(self, a):
-        self._soc.sendall(a)
+    def _waiting(self):
+        # 커널 버퍼에 쌓인 양을 복사 없이 확인 (pyserial의 in_waiting과 같은 방식)
+        if fcntl is None:
+            return 1 if select.select([self._soc], [], [], 0)[0] else 0
 
-    def set_pending_recv(self):
-        self._pending_recv = len(self._recv_buf)
+        buf = array.array("i", [0])
+        fcntl.ioctl(self._soc.fileno(), termios.FIONREAD, buf, True)
+        return buf[0]
 
-    def check_pending_recv(self):
-        return self._pending_recv
+    def send(self, a):
+        self._soc.sendall(a)
 
     def check_in_waiting(self):
-        if len(self._recv_buf) == 0:
-            new_data = self._recv_raw(256)
-            self._recv_buf.extend(new_data)
-        return len(self._recv_buf)
+        return self._buffered() + self._waiting()
+
+    def fileno(self):
+        return self._soc.fileno()
 
     def set_timeout(self, a):
         self._soc.settimeout(a)
@@ -719,7 +1034,7 @@ def mqtt_debug(topics, payload):
             packet = bytes(packet)
 
             logger.info("prepare packet:  {}".format(packet.hex()))
-            serial_queue[packet] = time.time()
+            serial_queue.push(packet)
 
             
 # KTDO: 수정 완료
@@ -783,7 +1098,7 @@ def mqtt_device(topics, payload):
     #packet[-1] = serial_generate_checksum(packet)
     #packet = bytes(packet)
     
-    serial_queue[packet] = time.time()
+    serial_queue.push(packet)
 
 
 # KTDO: 수정 완료
@@ -801,10 +1116,18 @@ def mqtt_init_discovery():
     
 # KTDO: 수정 완료
 def mqtt_on_message(mqtt, userdata, msg):
-    topics = msg.topic.split("/")
-    payload = msg.payload.decode()
+    # asyncio 엔진이 돌고 있으면 serial과 같은 loop에서 처리 (serial_queue 공유 문제 방지)
+    if serial_event_loop:
+        serial_event_loop.call_soon_threadsafe(mqtt_process_message, msg.topic, msg.payload)
+    else:
+        mqtt_process_message(msg.topic, msg.payload)
+
 
-    logger.info("recv. from HA:   {} = {}".format(msg.topic, payload))
+def mqtt_process_message(topic, payload):
+    topics = topic.split("/")
+    payload = payload.decode()
+
+    logger.info("recv. from HA:   {} = {}".format(topic, payload))
 
     device = topics[1]
     if device == "status":
@@ -828,7 +1151,11 @@ def mqtt_on_connect(mqtt, userdata, flags, rc):
     else:
         logger.error("MQTT connection return with:  {}".format(paho_mqtt.connack_string(rc)))
 
-    mqtt_init_discovery()
+    # discovery는 RS485_DEVICE를 초기화하므로 asyncio 엔진이 돌고 있으면 serial과 같은 loop에서 실행
+    if serial_event_loop:
+        serial_event_loop.call_soon_threadsafe(mqtt_init_discovery)
+    else:
+        mqtt_init_discovery()
 
     topic = "homeassistant/status"
     logger.info("subscribe {}".format(topic))
@@ -871,6 +1198,10 @@ def start_mqtt_loop():
 
     mqtt.loop_start()
 
+    global publisher
+    publisher = MqttPublisher(Options["mqtt"]["publish_queue_size"])
+    publisher.start()
+
     delay = 1
     while not mqtt_connected:
         logger.info("waiting MQTT connected ...")
@@ -1166,8 +1497,7 @@ def serial_receive_state(device, packet):
                 value = "OFF"
                 
             if last_topic_list.get(topic) != value:
-                logger.info("publish to HA:   {} = {} ({})".format(topic, value, packet.hex()))
-                mqtt.publish(topic, value)
+                publisher.publish(topic, value, packet, device)
                 last_topic_list[topic] = value
             
     elif device == "thermostat":
@@ -1192,20 +1522,16 @@ def serial_receive_state(device, packet):
             value4 = packet[9 + id * 2]
             
             if last_topic_list.get(topic1) != value1:
-                logger.info("publish to HA:   {} = {} ({})".format(topic1, value1, packet.hex()))
-                mqtt.publish(topic1, value1)
+                publisher.publish(topic1, value1, packet, device)
                 last_topic_list[topic1] = value1
             if last_topic_list.get(topic2) != value2:
-                logger.info("publish to HA:   {} = {} ({})".format(topic2, value2, packet.hex()))
-                mqtt.publish(topic2, value2)
+                publisher.publish(topic2, value2, packet, device)
                 last_topic_list[topic2] = value2
             if last_topic_list.get(topic3) != value3:
-                logger.info("publish to HA:   {} = {} ({})".format(topic3, value3, packet.hex()))
-                mqtt.publish(topic3, value3)
+                publisher.publish(topic3, value3, packet, device)
                 last_topic_list[topic3] = value3
             if last_topic_list.get(topic4) != value4:
-                logger.info("publish to HA:   {} = {} ({})".format(topic4, value4, packet.hex()))
-                mqtt.publish(topic4, value4)
+                publisher.publish(topic4, value4, packet, device)
                 last_topic_list[topic4] = value4
                 
 # KTDO: 위의 코드로 대체                        
@@ -1226,90 +1552,87 @@ def serial_receive_state(device, packet):
 #        last_topic_list[topic] = value
 
         
-# KTDO: 수정 완료
-def serial_get_header():
+def serial_get_packet():
     try:
-        # 0x80보다 큰 byte가 나올 때까지 대기
-        # KTDO: 시작 F7 찾기
-        while 1:
-            header_0 = conn.recv(1)[0]
-            #if header_0 >= 0x80: break
-            if header_0 == 0xF7: break
-
-        # 중간에 corrupt되는 data가 있으므로 연속으로 0x80보다 큰 byte가 나오면 먼젓번은 무시한다
-        # KTDO: 연속 0xF7 무시                                           
-        while 1:
-            header_1 = conn.recv(1)[0]
-            #if header_1 < 0x80: break
-            if header_1 != 0xF7: break
-            header_0 = header_1
-        
-        header_2 = conn.recv(1)[0]
-        header_3 = conn.recv(1)[0]
-        
+        # 완성된 패킷 하나를 받아옴 (checksum 검증 포함)
+        return conn.recv_packet()
+
     except (OSError, serial.SerialException):
         logger.error("ignore exception!")
-        header_0 = header_1 = header_2 = header_3 = 0
-
-    # 헤더 반환
-    return header_0, header_1, header_2, header_3
+        return None
 
 
 # KTDO: 수정 완료
 def serial_ack_command(packet):
-    logger.info("ack from device: {} ({:x})".format(serial_ack[packet].hex(), packet))
+    cmd = serial_ack.pop(packet)
+    logger.info("ack from device: {} ({:x})".format(cmd.packet.hex(), packet))
 
     # 성공한 명령을 지움
-    serial_queue.pop(serial_ack[packet], None)
-    serial_ack.pop(packet)
+    serial_queue.finish(cmd)
 
     
 # KTDO: 수정 완료
+# 실제로 패킷을 보냈는지 반환 (ready였어도 pop 중에 모두 만료되면 보내지 않음)
 def serial_send_command():
     # 한번에 여러개 보내면 응답이랑 꼬여서 망함
-    cmd = next(iter(serial_queue))
-    conn.send(cmd)
-
-    #ack = bytearray(cmd[0:3])
-    # KTDO: Ezville은 4 Byte까지 확인 필요
-    ack = bytearray(cmd[0:4])
-    ack[3] = ACK_MAP[cmd[1]][cmd[3]]
-    waive_ack = False
-    if ack[3] == 0x00:
-        waive_ack = True
-    ack = int.from_bytes(ack, "big")
-
-    # retry time 관리, 초과했으면 제거
-    elapsed = time.time() - serial_queue[cmd]
-    if elapsed > Options["rs485"]["max_retry"]:
-        logger.error("send to device:  {} max retry time exceeded!".format(cmd.hex()))
-        serial_queue.pop(cmd)
-        serial_ack.pop(ack, None)
-    elif elapsed > 3:
-        logger.warning("send to device:  {}, try another {:.01f} seconds...".format(cmd.hex(), Options["rs485"]["max_retry"] - elapsed))
-        serial_ack[ack] = cmd
-    elif waive_ack:
-        logger.info("waive ack:  {}".format(cmd.hex()))
-        serial_queue.pop(cmd)
-        serial_ack.pop(ack, None)
+    cmd = serial_queue.pop()
+    if cmd is None:
+        return False
+    conn.send(cmd.packet)
+
+    if cmd.waive_ack:
+        logger.info("waive ack:  {}".format(cmd.packet.hex()))
+        serial_queue.finish(cmd)
+        return True
+
+    if cmd.retries:
+        logger.warning("send to device:  {} (retry {}), try another {:.01f} seconds...".format(cmd.packet.hex(), cmd.retries, cmd.deadline - time.time()))
     else:
-        logger.info("send to device:  {}".format(cmd.hex()))
-        serial_ack[ack] = cmd
+        logger.info("send to device:  {}".format(cmd.packet.hex()))
+
+    serial_ack[cmd.ack] = cmd
+    serial_queue.sent(cmd)
+    return True
+
+
+# 명령 큐, publish 큐 통계를 로그와 MQTT로 내보냄
+def serial_report_stats():
+    prefix = Options["mqtt"]["prefix"]
+
+    stats = serial_queue.stats()
+    if stats["depth"] or stats["done"] or stats["expired"]:
+        logger.info("command queue: {}".format(stats))
+        if mqtt_connected:
+            mqtt.publish("{}/debug/queue/state".format(prefix), json.dumps(stats))
+
+    stats = publisher.stats()
+    if stats["replaced"] or stats["dropped"]:
+        logger.info("publish queue: {}".format(stats))
+    if mqtt_connected:
+        mqtt.publish("{}/debug/publish/state".format(prefix), json.dumps(stats))
 
 # KTDO: 수정 완료
-def serial_loop():
+def serial_packet_handler():
+    # 받은 패킷을 send()로 하나씩 넘겨받아 처리, 루프 상태는 지역 변수로 유지
     logger.info("start loop ...")
     loop_count = 0
     scan_count = 0
     send_aggressive = False
 
     start_time = time.time()
+    stats_time = start_time
     while True:
+        packet = yield
+
         # 로그 출력
         sys.stdout.flush()
 
-        # 첫 Byte만 0x80보다 큰 두 Byte를 찾음
-        header_0, header_1, header_2, header_3 = serial_get_header()
+        # 명령 큐 통계는 주기적으로 출력
+        if time.time() - stats_time > SERIAL_STATS_PERIOD:
+            serial_report_stats()
+            stats_time = time.time()
+
+        header_0, header_1, header_2, header_3 = packet[0:4]
         # KTDO: 패킷단위로 분석할 것이라 합치지 않음.
         # header = (header_0 << 8) | header_1
 
@@ -1334,26 +1657,11 @@ def serial_loop():
             # 몇 Byte짜리 패킷인지 확인
             #device, remain = STATE_HEADER[header]
             device = STATE_HEADER[header_1][0]
-            # KTDO: 데이터 길이는 다음 패킷에서 확인
-            header_4 = conn.recv(1)[0]
-            data_length = int(header_4)
-            
-            # KTDO: packet 생성 위치 변경
-            packet = bytes([header_0, header_1, header_2, header_3, header_4])
-            
-            # 해당 길이만큼 읽음
-            # KTDO: 데이터 길이 + 2 (XOR + ADD) 만큼 읽음
-            packet += conn.recv(data_length + 2)
-
-            # checksum 오류 없는지 확인
-            # KTDO: checksum 및 ADD 오류 없는지 확인 
-            if not serial_verify_checksum(packet):
-                continue
 
             # 디바이스 응답 뒤에도 명령 보내봄
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
+            if serial_queue.ready() and not conn.check_pending_recv():
+                if serial_send_command():
+                    conn.set_pending_recv()
 
             # 적절히 처리한다
             serial_receive_state(device, packet)
@@ -1385,9 +1693,9 @@ def serial_loop():
         
         #if header_1 == HEADER_1_SCAN or send_aggressive:
             scan_count += 1
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
+            if serial_queue.ready() and not conn.check_pending_recv():
+                if serial_send_command():
+                    conn.set_pending_recv()
 
         # 전체 루프 수 카운트
         # KTDO: 가스 밸브 쿼리로 확인
@@ -1421,6 +1729,80 @@ def serial_loop():
             start_time = time.time()
             scan_count = 0
 
+def serial_loop():
+    handler = serial_packet_handler()
+    next(handler)
+
+    while True:
+        # 패킷 단위로 받아옴
+        packet = serial_get_packet()
+        if packet is not None:
+            handler.send(packet)
+
+
+def serial_async_loop():
+    # serial/socket fd가 읽을 수 있을 때만 깨어나서, 받은 패킷을 바로 처리
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    handler = serial_packet_handler()
+    next(handler)
+    failure = []
+
+    def drain():
+        # 처리 중 예외는 asyncio가 로그만 남기고 넘어가므로, 직접 잡아서 loop를 멈추고 호출한 쪽으로 전달
+        # (blocking 엔진과 같이 애드온 종료, 죽은 handler로 계속 도는 것 방지)
+        while not failure:
+            packet = conn.next_packet()
+            if packet is None:
+                break
+            try:
+                handler.send(packet)
+            except Exception as e:
+                failure.append(e)
+                loop.stop()
+
+    def on_readable():
+        if failure:
+            return
+        try:
+            conn.fill()
+        except (OSError, serial.SerialException):
+            logger.error("ignore exception!")
+            return
+        except EOFError as e:
+            failure.append(e)
+            loop.stop()
+            return
+
+        drain()
+
+    try:
+        loop.add_reader(conn.fileno(), on_readable)
+    except (NotImplementedError, AttributeError):
+        # Windows 등 fd 감시가 안되는 환경
+        logger.warning("asyncio engine is not supported on this platform! fall back to blocking loop...")
+        loop.close()
+        return serial_loop()
+
+    # 이제부터 MQTT 명령도 이 loop에서 처리
+    global serial_event_loop
+    serial_event_loop = loop
+
+    # dump 등으로 이미 버퍼에 들어와 있는 패킷 먼저 처리
+    loop.call_soon(drain)
+
+    try:
+        loop.run_forever()
+    finally:
+        serial_event_loop = None
+        loop.remove_reader(conn.fileno())
+        loop.close()
+
+    if failure:
+        raise failure[0]
+
+
 # KTDO: 수정 완료
 def dump_loop():
     dump_time = Options["rs485"]["dump_time"]
@@ -1476,6 +1858,9 @@ if __name__ == "__main__":
 
     try:
         # 무한 루프
-        serial_loop()
+        if Options["rs485"]["engine"] == "asyncio":
+            serial_async_loop()
+        else:
+            serial_loop()
     except:
         logger.exception("addon finished!")
@@ -2,13 +2,22 @@ import paho.mqtt.client as mqtt
 import json
 import time
 import asyncio
+import sys
 import threading
-import telnetlib
 import socket
 import random
+import base64
+import queue
+import atexit
+import struct
+import argparse
+import os
+import signal
+import logging
+import logging.handlers
 
 from threading import Thread
-from queue import Queue
+from collections import deque
 
 # DEVICE 별 패킷 정보
 RS485_DEVICE = {
@@ -134,26 +143,71 @@ DISCOVERY_PAYLOAD = {
     } ]
 }
 
-# STATE 확인용 Dictionary
+# STATE 확인용 Dictionary (수신 패킷을 byte 단위로 비교하므로 정수로 저장)
 STATE_HEADER = {
-    prop['state']['id']: (device, prop['state']['cmd'])
+    int(prop['state']['id'], 16): (device, int(prop['state']['cmd'], 16))
     for device, prop in RS485_DEVICE.items()
     if 'state' in prop
 }
 
 # ACK 확인용 Dictionary
 ACK_HEADER = {
-    prop[cmd]['id']: (device, prop[cmd]['ack'])
+    int(prop[cmd]['id'], 16): (device, int(prop[cmd]['ack'], 16))
     for device, prop in RS485_DEVICE.items()
         for cmd, code in prop.items()
             if 'ack' in code
 }
 
-# LOG 메시지
-def log(string):
-    date = time.strftime('%Y-%m-%d %p %I:%M:%S', time.localtime(time.time()))
-    print('[{}] {}'.format(date, string))
-    return
+# LOG 메시지 - 포맷팅과 출력은 별도 Thread(QueueListener)에서 처리되므로 호출 시에는 Queue에 넣기만 함
+logger = logging.getLogger('ezville')
+
+# 카테고리(EW11_LOG, MQTT_LOG, DEBUG_LOG)별 샘플링 - N개 중 1개만 출력
+LOG_SAMPLE = {}
+LOG_COUNT = {}
+
+# 메시지 포맷팅을 Listener Thread로 미루는 QueueHandler (인자는 호출 시점의 값이 유지되는 immutable 값만 전달)
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+def init_logger(sample):
+    log_queue = queue.SimpleQueue()
+    
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %p %I:%M:%S'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    logger.handlers = [LazyQueueHandler(log_queue)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    
+    LOG_SAMPLE.update(sample)
+
+# 인자가 있으면 '%s' 형식으로 출력 시점에 포맷팅, category가 있으면 해당 카테고리의 샘플링 적용
+def log(string, *args, category=None):
+    if category is not None and LOG_SAMPLE.get(category, 1) > 1:
+        count = LOG_COUNT[category] = LOG_COUNT.get(category, 0) + 1
+        if count % LOG_SAMPLE[category]:
+            return
+    logger.info(string, *args)
+
+# 패킷을 출력 시점에 HEX 문자열로 변환
+class HexDump:
+    __slots__ = ('data',)
+    
+    def __init__(self, data):
+        self.data = bytes(data)
+        
+    def __str__(self):
+        return self.data.hex().upper()
+
+# 정렬된 sample에서 백분위 값 계산
+def percentile(samples, p):
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
 
 # CHECKSUM 및 ADD를 마지막 4 BYTE에 추가
 def checksum(input_hex):
@@ -176,6 +230,409 @@ def checksum(input_hex):
     except:
         return None
 
+
+# 수신 패킷(bytes)의 XOR 및 ADD 검증
+def verify_checksum(packet):
+    checksum = 0
+    for b in packet[:-2]:
+        checksum ^= b
+
+    return packet[-2] == checksum and packet[-1] == (sum(packet[:-1])) & 0xFF
+
+
+# EW11 수신 버퍼에서 완성된 패킷을 분리
+# [F7] [ID] [GROUP] [CMD] [LEN] [DATA x LEN] [XOR] [ADD] 형식의 패킷을 memoryview로 복사 없이 넘겨주고,
+# 처리가 끝나면 완성되지 않은 나머지만 buffer에 남긴다.
+# 넘겨준 memoryview는 다음 패킷을 받기 전까지만 유효하므로 보관이 필요하면 bytes로 복사해야 함
+# stats(Metrics)가 주어지면 Checksum 오류 및 패킷 경계를 다시 찾은(중간 데이터를 버린) 횟수를 기록
+def split_packets(buffer, stats=None):
+    view = memoryview(buffer)
+    end = len(buffer)
+    
+    k = buffer.find(0xF7)
+    consumed = end if k < 0 else k
+    if stats is not None and k != 0 and end:
+        stats.resync += 1
+    try:
+        while k >= 0:
+            # 남은 데이터가 최소 패킷 길이 혹은 예상되는 패킷 길이보다 짧으면 다음 수신 때 이어서 처리
+            if k + 5 > end or k + 7 + buffer[k + 4] > end:
+                consumed = k
+                break
+            
+            packet_length = 7 + buffer[k + 4]
+            packet = view[k:k + packet_length]
+            
+            # 분리된 패킷이 Valid한 패킷인지 Checksum 확인, 아니면 다음 F7부터 다시 탐색
+            if verify_checksum(packet):
+                yield packet
+                k += packet_length
+            else:
+                k += 1
+                if stats is not None:
+                    stats.checksum += 1
+            packet.release()
+            
+            consumed = k
+            k = buffer.find(0xF7, consumed)
+            if stats is not None and (k > consumed or (k < 0 and consumed < end)):
+                stats.resync += 1
+            if k < 0:
+                consumed = end
+    finally:
+        view.release()
+        del buffer[:consumed]
+
+
+# 장치별 STATE/ACK 패킷 Decoder
+# 패킷(bytes 혹은 memoryview)을 받아 [((장치, ID1, ID2), 속성, 값), ...] 형태의 업데이트 목록을 반환
+
+# 조명: [에러] [1번 조명 상태] ... [n번 조명 상태], ROOM ID는 GROUP의 하위 4 BIT
+def decode_light(packet):
+    rid = packet[2] & 0x0F
+    
+    return [(('light', rid, id), 'power', 'ON' if packet[5 + id] else 'OFF') for id in range(1, packet[4])]
+
+# 난방: [에러] [난방 상태] [외출 상태] [예약] [온수] [1번 설정온도] [1번 현재온도] ...
+# 각 room의 난방/외출 상태는 BIT (room 번호 - 1), room의 조절기 수는 현재 하나 뿐임
+def decode_thermostat(packet):
+    onoff_state = packet[6]
+    away_state = packet[7]
+    
+    updates = []
+    for rid in range(1, (packet[4] - 5) // 2 + 1):
+        bit = 1 << (rid - 1)
+        if onoff_state & bit:
+            updates.append((('thermostat', rid, 1), 'power', 'heat'))
+        # 외출 모드는 off로, 난방/외출 모두 아닌 경우는 전원 상태 업데이트하지 않음
+        elif away_state & bit:
+            updates.append((('thermostat', rid, 1), 'power', 'off'))
+        
+        updates.append((('thermostat', rid, 1), 'curTemp', str(packet[9 + 2 * rid])))
+        updates.append((('thermostat', rid, 1), 'setTemp', str(packet[8 + 2 * rid])))
+    return updates
+
+# 대기전력: [plug 갯수] [상위 4 BIT 자동모드 / 하위 4 BIT On/Off] [전력량 2 Byte] ...
+def decode_plug(packet):
+    rid = packet[2] & 0x0F
+    
+    updates = []
+    for id in range(1, packet[5] + 1):
+        flag = packet[3 + 3 * id]
+        updates.append((('plug', rid, id), 'power', 'ON' if flag & 0x0F else 'OFF'))
+        updates.append((('plug', rid, id), 'auto', 'ON' if flag >> 4 else 'OFF'))
+        updates.append((('plug', rid, id), 'current', '{:.2f}'.format(((packet[4 + 3 * id] << 8) | packet[5 + 3 * id]) / 100)))
+    return updates
+
+# 가스밸브: 하나 뿐이라 ID 강제 설정
+def decode_gasvalve(packet):
+    return [(('gasvalve', 1, 1), 'power', 'ON' if packet[6] == 1 else 'OFF')]
+
+# 일괄차단기: 하나 뿐이라 ID 강제 설정, BIT5: 엘리베이터 하향, BIT4: 상향, BIT2: 그룹 조명, BIT1: 외출
+def decode_batch(packet):
+    states = packet[6]
+    
+    return [
+        (('batch', 1, 1), 'elevator-down', 'ON' if states & 0x20 else 'OFF'),
+        (('batch', 1, 1), 'elevator-up', 'ON' if states & 0x10 else 'OFF'),
+        (('batch', 1, 1), 'group', 'ON' if states & 0x04 else 'OFF'),
+        (('batch', 1, 1), 'outing', 'ON' if states & 0x02 else 'OFF')
+    ]
+
+DEVICE_DECODER = {
+    'light': decode_light,
+    'thermostat': decode_thermostat,
+    'plug': decode_plug,
+    'gasvalve': decode_gasvalve,
+    'batch': decode_batch
+}
+
+# plug와 일괄차단기는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
+STATE_ONLY_DEVICE = ['plug', 'batch']
+
+# (장치 ID << 8 | 명령 코드)로 찾는 Decoder
+PACKET_DECODER = {
+    id << 8 | cmd: DEVICE_DECODER[device]
+    for id, (device, cmd) in STATE_HEADER.items()
+}
+PACKET_DECODER.update({
+    id << 8 | ack: DEVICE_DECODER[device]
+    for id, (device, ack) in ACK_HEADER.items()
+    if device not in STATE_ONLY_DEVICE
+})
+
+# ACK 패킷도 State로 저장하는 장치 (난방 ACK는 전체 상태를 포함)
+ACK_CACHE_HEADER = {
+    0x36: b'\xF7\x36\x1F\x81\x0F'
+}
+
+# HA로 Publish하지 않고 DEVICE_STATE에만 저장하는 속성 (일괄차단기 명령 생성에 사용)
+LOCAL_STATE = {'elevator-up', 'elevator-down'}
+
+# 자주 Publish되는 State 값은 미리 encode
+STATE_PAYLOAD = {value: value.encode() for value in ('ON', 'OFF', 'heat', 'off')}
+
+
+# EW11에 보낼 Command 저장소
+# 같은 장치 속성(statcmd[0], 예: light_01_02power)의 명령이 아직 전송 전이면 새 명령으로 교체 (Queue 내 순서는 유지)
+class CommandQueue:
+    def __init__(self):
+        self._pending = {}
+        self._event = asyncio.Event()
+        
+        # 통계: 등록된 명령 수, 전송 전에 교체/취소되어 생략된 명령 수
+        self.queued = 0
+        self.coalesced = 0
+
+    async def put(self, cmd):
+        key = cmd['statcmd'][0]
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = cmd
+        self.queued += 1
+        self._event.set()
+
+    # 전송 전인 명령 취소 (현재 상태로 되돌리는 명령이 들어온 경우)
+    def discard(self, key):
+        if self._pending.pop(key, None) is not None:
+            self.coalesced += 1
+            return True
+        return False
+
+    # busy에 포함된 장치(RS485 ID + 방 번호) 대상이 아닌 명령 중 가장 먼저 들어온 명령을 꺼냄
+    async def get(self, busy=()):
+        while True:
+            for key, cmd in self._pending.items():
+                if cmd['sendcmd'][2:6] not in busy:
+                    return self._pending.pop(key)
+            self._event.clear()
+            await self._event.wait()
+
+    # 전송 중이던 장치가 비면 대기 중인 명령을 다시 확인
+    def wake(self):
+        self._event.set()
+
+    def empty(self):
+        return not self._pending
+
+    def qsize(self):
+        return len(self._pending)
+
+
+# 동작 통계 (metrics_mode가 off이면 생성하지 않으며, 수집하는 쪽에서는 None 여부만 확인)
+class Metrics:
+    # ACK 지연 시간 Histogram 구간 (초)
+    ACK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self):
+        # RS485 ID별 수신 패킷 수, 수신 Byte 수
+        self.frames = {}
+        self.recv_bytes = 0
+        
+        # Checksum 오류 및 패킷 경계 재탐색 횟수
+        self.checksum = 0
+        self.resync = 0
+        
+        # 명령 재전송 / 완료 / 실패 횟수 및 마지막 전송부터 ACK(혹은 목표 State)까지 걸린 시간 Histogram
+        self.retries = 0
+        self.commands = {'done': 0, 'failed': 0}
+        self.ack_buckets = [0] * len(self.ACK_BUCKETS)
+        self.ack_sum = 0.0
+        self.ack_count = 0
+
+    def observe_command(self, succeeded, elapsed):
+        if not succeeded:
+            self.commands['failed'] += 1
+            return
+        self.commands['done'] += 1
+        self.ack_sum += elapsed
+        self.ack_count += 1
+        for i, bound in enumerate(self.ACK_BUCKETS):
+            if elapsed <= bound:
+                self.ack_buckets[i] += 1
+                break
+
+    # Prometheus Text 형식 (gauges는 호출 시점의 Queue 길이 등)
+    def render(self, gauges):
+        lines = ['# TYPE ezville_frames_total counter']
+        for id, count in sorted(self.frames.items()):
+            lines.append('ezville_frames_total{{id="{:02X}"}} {}'.format(id, count))
+        lines.append('# TYPE ezville_recv_bytes_total counter')
+        lines.append('ezville_recv_bytes_total {}'.format(self.recv_bytes))
+        lines.append('# TYPE ezville_checksum_errors_total counter')
+        lines.append('ezville_checksum_errors_total {}'.format(self.checksum))
+        lines.append('# TYPE ezville_resyncs_total counter')
+        lines.append('ezville_resyncs_total {}'.format(self.resync))
+        lines.append('# TYPE ezville_command_retries_total counter')
+        lines.append('ezville_command_retries_total {}'.format(self.retries))
+        lines.append('# TYPE ezville_commands_total counter')
+        for result, count in self.commands.items():
+            lines.append('ezville_commands_total{{result="{}"}} {}'.format(result, count))
+        
+        lines.append('# TYPE ezville_ack_latency_seconds histogram')
+        cumulative = 0
+        for bound, count in zip(self.ACK_BUCKETS, self.ack_buckets):
+            cumulative += count
+            lines.append('ezville_ack_latency_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+        lines.append('ezville_ack_latency_seconds_bucket{{le="+Inf"}} {}'.format(self.ack_count))
+        lines.append('ezville_ack_latency_seconds_sum {}'.format(self.ack_sum))
+        lines.append('ezville_ack_latency_seconds_count {}'.format(self.ack_count))
+        
+        # gauges 중 _total로 끝나는 값은 누적 값 (CommandQueue 통계 등)
+        for name, value in gauges.items():
+            lines.append('# TYPE ezville_{} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            lines.append('ezville_{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    # MQTT 전달용 (초당 패킷 수는 이전 호출 이후 변화량으로 계산)
+    def snapshot(self, gauges, frames_before, elapsed):
+        return dict(gauges,
+                    frames_per_sec={'{:02X}'.format(id): round((count - frames_before.get(id, 0)) / elapsed, 2) for id, count in self.frames.items()},
+                    recv_bytes=self.recv_bytes,
+                    checksum_errors=self.checksum,
+                    resyncs=self.resync,
+                    command_retries=self.retries,
+                    commands=dict(self.commands),
+                    ack_latency_avg=round(self.ack_sum / self.ack_count, 3) if self.ack_count else None,
+                    ack_latency_buckets=dict(zip([str(bound) for bound in self.ACK_BUCKETS], self.ack_buckets)))
+
+
+# EW11 수신 데이터 기록 파일 형식
+# CAPTURE_MAGIC 다음에 [수신 시각 (time.monotonic, double)] [길이 (uint32)] [수신 데이터] 반복
+CAPTURE_MAGIC = b'EZVCAP1\n'
+CAPTURE_RECORD = struct.Struct('<dI')
+
+def open_capture(path):
+    file = open(path, 'ab', buffering=65536)
+    if file.tell() == 0:
+        file.write(CAPTURE_MAGIC)
+    atexit.register(file.close)
+    return file
+
+# [(수신 시각, 수신 데이터)] 반환 (기록 중 종료되어 잘린 마지막 데이터는 버림)
+def read_capture(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError('EW11 기록 파일 형식이 아닙니다: {}'.format(path))
+    
+    chunks = []
+    k = len(CAPTURE_MAGIC)
+    while k + CAPTURE_RECORD.size <= len(data):
+        timestamp, length = CAPTURE_RECORD.unpack_from(data, k)
+        k += CAPTURE_RECORD.size
+        if k + length > len(data):
+            break
+        chunks.append((timestamp, data[k:k + length]))
+        k += length
+    return chunks
+
+
+# 기록 재생 시 MQTT Client 대신 사용 (Publish 횟수만 셈)
+class PublishCounter:
+    def __init__(self):
+        self.count = 0
+        
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.count += 1
+
+
+# EW11 리셋용 Telnet 제어 코드
+TELNET_IAC = 255
+TELNET_DONT = 254
+TELNET_DO = 253
+TELNET_WONT = 252
+TELNET_WILL = 251
+TELNET_SB = 250
+TELNET_SE = 240
+
+# EW11 리셋용 Telnet 연결 (telnetlib 대체)
+# 한 번에 읽은 데이터 중 기다리던 문자열 뒤에 붙어 온 부분과 중간에 잘린 Telnet 제어 코드는 연결 단위로 보관했다가 다음 읽기에 이어서 사용
+class TelnetSession:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        
+        # 제어 코드를 걸러낸 데이터 중 아직 소비하지 않은 부분, 다음 수신 데이터와 합쳐서 해석할 잘린 제어 코드
+        self.text = bytearray()
+        self.partial = b''
+
+    # Telnet 옵션 협상은 모두 거절하고 나머지 데이터만 self.text에 추가
+    def feed(self, data):
+        data = self.partial + data
+        self.partial = b''
+        
+        i = 0
+        while i < len(data):
+            if data[i] != TELNET_IAC:
+                self.text.append(data[i])
+                i += 1
+            elif i + 1 >= len(data):
+                break
+            elif data[i + 1] in (TELNET_DO, TELNET_DONT, TELNET_WILL, TELNET_WONT):
+                if i + 2 >= len(data):
+                    break
+                if data[i + 1] == TELNET_DO:
+                    self.writer.write(bytes([TELNET_IAC, TELNET_WONT, data[i + 2]]))
+                elif data[i + 1] == TELNET_WILL:
+                    self.writer.write(bytes([TELNET_IAC, TELNET_DONT, data[i + 2]]))
+                i += 3
+            elif data[i + 1] == TELNET_SB:
+                end = data.find(bytes([TELNET_IAC, TELNET_SE]), i)
+                if end < 0:
+                    break
+                i = end + 2
+            elif data[i + 1] == TELNET_IAC:
+                self.text.append(TELNET_IAC)
+                i += 2
+            else:
+                i += 2
+        
+        self.partial = data[i:]
+
+    # expected 문자열이 나올 때까지 읽고 expected까지만 소비하여 반환 (timeout초 초과 시 asyncio.TimeoutError)
+    async def read_until(self, expected, timeout):
+        async def read():
+            while expected not in self.text:
+                data = await self.reader.read(256)
+                if not data:
+                    raise ConnectionResetError('EW11 Telnet 연결 종료')
+                self.feed(data)
+        
+        await asyncio.wait_for(read(), timeout)
+        end = self.text.index(expected) + len(expected)
+        received = bytes(self.text[:end])
+        del self.text[:end]
+        return received
+
+# Telnet 접속하여 EW11 리셋, 각 단계는 timeout초 안에 끝나야 함
+async def reset_ew11_telnet(host, user, password, timeout, port=23):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    session = TelnetSession(reader, writer)
+    try:
+        await session.read_until(b'login:', timeout)
+        writer.write(user.encode('utf-8') + b'\n')
+        await session.read_until(b'password:', timeout)
+        writer.write(password.encode('utf-8') + b'\n')
+        writer.write(b'Restart\n')
+        await session.read_until(b'Restart..', timeout)
+    finally:
+        writer.close()
+
+# EW11 웹 관리 페이지의 재시작 주소를 호출하여 리셋, 응답이 200이면 성공
+async def reset_ew11_http(host, user, password, path, timeout, port=80):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        auth = base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+        request = 'GET {} HTTP/1.0\r\nHost: {}\r\nAuthorization: Basic {}\r\n\r\n'.format(path, host, auth)
+        writer.write(request.encode('ascii'))
+        
+        status = await asyncio.wait_for(reader.readline(), timeout)
+        if status.split()[1:2] != [b'200']:
+            raise ConnectionError('EW11 재시작 요청 실패: {}'.format(status.decode('latin-1').strip()))
+    finally:
+        writer.close()
+
     
 config_dir = '/data'
 
@@ -183,15 +640,19 @@ HA_TOPIC = 'ezville'
 STATE_TOPIC = HA_TOPIC + '/{}/{}/state'
 EW11_TOPIC = 'ew11'
 EW11_SEND_TOPIC = EW11_TOPIC + '/send'
+METRICS_TOPIC = HA_TOPIC + '/metrics'
+METRICS_PORT = 9100
 
 
 # Main Function
-def ezville_loop(config):
+# replay가 (기록 파일, 실시간 여부)로 주어지면 MQTT/EW11 연결 없이 기록된 데이터만 처리하고 결과 반환
+def ezville_loop(config, replay=None):
     
     # Log 생성 Flag
     debug = config['DEBUG_LOG']
     mqtt_log = config['MQTT_LOG']
     ew11_log = config['EW11_LOG']
+    init_logger({'debug': config['DEBUG_LOG_SAMPLE'], 'mqtt': config['MQTT_LOG_SAMPLE'], 'ew11': config['EW11_LOG_SAMPLE']})
     
     # 통신 모드 설정: mixed, socket, mqtt
     comm_mode = config['mode']
@@ -200,30 +661,82 @@ def ezville_loop(config):
     SOC_ADDRESS = config['ew11_server']
     SOC_PORT = config['ew11_port']
     
-    # EW11 혹은 HA 전달 메시지 저장소
-    MSG_QUEUE = Queue()
+    # Socket 연결 대기 시간 및 재연결 간격 상한 (1, 2, 4, ...초로 늘리되 socket_backoff_max초를 넘지 않음)
+    SOC_CONNECT_TIMEOUT = config['socket_connect_timeout']
+    SOC_BACKOFF_MAX = config['socket_backoff_max']
+    
+    # Socket 송수신용 asyncio stream, 재연결 중복 방지용 Lock 및 연결 상태 Event (연결 중에만 set)
+    soc_reader = None
+    soc_writer = None
+    SOC_LOCK = asyncio.Lock()
+    SOC_CONNECTED = asyncio.Event()
+    
+    # Socket 재연결 통계 - 재연결 횟수 및 끊겨 있던 누적 시간(초)
+    SOC_STATS = {'reconnect': 0, 'downtime': 0.0}
+    
+    # EW11 혹은 HA 전달 메시지 저장소 (MQTT Thread에서 asyncio loop로 전달되어 바로 처리)
+    MSG_QUEUE = asyncio.Queue()
+    
+    # 메시지 수신부터 처리(HA Publish)까지 걸린 시간 기록, DEBUG 모드에서 LATENCY_REPORT_PERIOD초마다 p50/p99 출력
+    MSG_LATENCY = deque(maxlen=1000)
+    LATENCY_REPORT_PERIOD = 60
     
     # EW11에 보낼 Command 및 예상 Acknowledge 패킷 
-    CMD_QUEUE = asyncio.Queue()
+    CMD_QUEUE = CommandQueue()
+    
+    # 전송 중인 Command의 완료 대기용 Future (ACK 헤더 4 Byte 혹은 DEVICE_STATE key로 찾음)
+    CMD_ACK = {}
+    CMD_TARGET = {}
+    
+    # 동시에 진행할 수 있는 명령 수 (같은 장치 - RS485 ID + 방 번호 - 에는 하나씩만 진행), 전송 중인 장치 목록 및 진행 중인 Task
+    # Task는 참조를 들고 있지 않으면 실행 중에 GC될 수 있으므로 완료될 때까지 보관
+    CMD_CONCURRENCY = max(config['command_concurrency'], 1)
+    CMD_INFLIGHT = set()
+    CMD_TASKS = set()
+    
+    # 여러 명령이 동시에 진행되어도 EW11로의 전송은 한번에 하나씩
+    SEND_LOCK = asyncio.Lock()
     
     # State 저장용 공간
     DEVICE_STATE = {}
     
+    # (장치, 속성, ID1, ID2)별 DEVICE_STATE key, State Topic 및 마지막 Publish 값 [key, topic, value]
+    STATE_ENTRY = {}
+    
+    # 계속 조금씩 바뀌는 수치 센서는 마지막 Publish 값에서 변화폭(deadband) 이상 바뀐 경우만 Publish
+    # 단, 마지막 Publish 후 최소 간격 전에는 Publish하지 않고, 최대 간격이 지나면 변화폭과 관계없이 Publish
+    NUMERIC_MIN_INTERVAL = config['numeric_min_interval']
+    NUMERIC_MAX_INTERVAL = config['numeric_max_interval']
+    NUMERIC_DEADBAND = {
+        ('plug', 'current'): config['plug_current_deadband'],
+        ('thermostat', 'curTemp'): config['thermostat_temp_deadband']
+    }
+    
+    # 수치 센서 (장치, 속성, ID1, ID2)별 마지막 Publish 시각 및 Publish 보류 중인 값
+    NUMERIC_PUBLISHED = {}
+    NUMERIC_PENDING = {}
+    
     # 이전에 전달된 패킷인지 판단을 위한 캐쉬
     MSG_CACHE = {}
     
     # MQTT Discovery Que
     DISCOVERY_DELAY = config['discovery_delay']
-    DISCOVERY_LIST = []
+    DISCOVERY_LIST = set()
+    DISCOVERY_QUEUE = asyncio.Queue()
+    
+    # 등록된 장치 목록, 마지막 State 및 패킷 캐쉬를 state_snapshot_period초마다, 그리고 종료 시 저장 (0이면 사용 안 함)
+    # 시작 시 불러와서 이미 등록된 장치의 Discovery와 바뀌지 않은 State의 Publish를 생략
+    SNAPSHOT_FILE = config_dir + '/ezville_state.json'
+    SNAPSHOT_PERIOD = config['state_snapshot_period']
     
     # EW11 전달 패킷 중 처리 후 남은 짜투리 패킷 저장
-    RESIDUE = ''
+    RESIDUE = bytearray()
     
-    # 강제 주기적 업데이트 설정 - 매 force_update_period 마다 force_update_duration초간 HA 업데이트 실시
-    FORCE_UPDATE = False
+    # 강제 주기적 업데이트 설정 - 저장된 모든 State를 force_update_period초에 한번씩 고르게 나누어 HA에 다시 전달
+    # 단, 초당 force_update_rate개 (최소 0.1개) 이상은 전달하지 않음
     FORCE_MODE = config['force_update_mode']
     FORCE_PERIOD = config['force_update_period']
-    FORCE_DURATION = config['force_update_duration']
+    FORCE_RATE = max(config['force_update_rate'], 0.1)
     
     # Command를 EW11로 보내는 방식 설정 (동시 명령 횟수, 명령 간격 및 재시도 횟수)
     CMD_INTERVAL = config['command_interval']
@@ -231,10 +744,23 @@ def ezville_loop(config):
     FIRST_WAITTIME = config['first_waittime']
     RANDOM_BACKOFF = config['random_backoff']
     
-    # State 업데이트 루프 / Command 실행 루프 / Socket 통신으로 패킷 받아오는 루프 / Restart 필요한지 체크하는 루프의 Delay Time 설정
+    # 월패드 Polling에 맞춘 명령 전송 설정 - 대상 장치의 State 응답 직후 (다음 Polling 전 빈 구간)에 전송
+    # bus_slot_timeout초 (혹은 대상 장치 Polling 주기의 1.5배) 안에 응답이 없으면 그대로 전송
+    BUS_SLOT_MODE = config['bus_slot_mode']
+    BUS_SLOT_TIMEOUT = config['bus_slot_timeout']
+    
+    # RS485 ID별 빈 구간을 기다리는 전송 목록 [(GROUP, Future)]
+    BUS_SLOT_WAITER = {}
+    
+    # (RS485 ID, GROUP)별 [마지막 State 응답 시각, 평균 Polling 주기]
+    BUS_POLL = {}
+    
+    # 빈 구간 전송 통계 - 빈 구간에 전송 / 대기 시간 초과로 전송 횟수, 빈 구간 평균 길이(초) 및 측정용 시각
+    BUS_STATS = {'slot': 0, 'timeout': 0, 'gap': None, 'opened': None}
+    
+    # State 업데이트 루프 / Command 실행 루프 / Restart 필요한지 체크하는 루프의 Delay Time 설정
     STATE_LOOP_DELAY = config['state_loop_delay']
     COMMAND_LOOP_DELAY = config['command_loop_delay']
-    SERIAL_RECV_DELAY = config['serial_recv_delay']
     RESTART_CHECK_DELAY = config['restart_check_delay']
     
     # EW11에 설정된 BUFFER SIZE
@@ -244,6 +770,19 @@ def ezville_loop(config):
     EW11_TIMEOUT = config['ew11_timeout']
     last_received_time = time.time()
     
+    # EW11 리셋 설정 - 각 단계별 응답 대기 시간 및 HTTP 재시작 사용 여부
+    EW11_RESET_TIMEOUT = config['ew11_reset_timeout']
+    EW11_HTTP_RESET = config['ew11_http_reset']
+    EW11_HTTP_RESET_PATH = config['ew11_http_reset_path']
+    
+    # EW11 수신 데이터 기록 (ew11_capture_file이 지정된 경우)
+    CAPTURE = open_capture(config['ew11_capture_file']) if config.get('ew11_capture_file') else None
+    
+    # 동작 통계 제공 방식 (off / http: METRICS_PORT에서 Prometheus 형식 / mqtt: metrics_period초마다 METRICS_TOPIC에 JSON)
+    METRICS_MODE = config['metrics_mode']
+    METRICS_PERIOD = config['metrics_period']
+    METRICS = Metrics() if METRICS_MODE != 'off' else None
+    
     # EW11 재시작 확인용 Flag
     restart_flag = False
   
@@ -284,7 +823,6 @@ def ezville_loop(config):
         
     # MQTT 메시지 Callback
     def on_message(client, userdata, msg):
-        nonlocal MSG_QUEUE
         nonlocal MQTT_ONLINE
         nonlocal startup_delay
         
@@ -302,9 +840,14 @@ def ezville_loop(config):
                 elif status == 'offline':
                     log('[INFO] MQTT Integration 오프라인')
                     MQTT_ONLINE = False
-        # 나머지 topic은 모두 Queue에 보관
+        # 나머지 topic은 모두 asyncio loop의 Queue로 전달해 바로 처리
         else:
-            MSG_QUEUE.put(msg)
+            loop.call_soon_threadsafe(queue_message, msg)
+
+
+    # MQTT Thread에서 전달된 메시지를 Queue에 보관 (asyncio loop에서 실행)
+    def queue_message(msg):
+        MSG_QUEUE.put_nowait(msg)
  
 
     # MQTT 통신 연결 해제 Callback
@@ -316,277 +859,151 @@ def ezville_loop(config):
 
     # MQTT message를 분류하여 처리
     async def process_message():
-        # MSG_QUEUE의 message를 하나씩 pop
-        nonlocal MSG_QUEUE
+        # MSG_QUEUE에 message가 들어오는 즉시 하나씩 pop
         nonlocal last_received_time
         
-        stop = False
-        while not stop:
-            if MSG_QUEUE.empty():
-                stop = True
-            else:
-                msg = MSG_QUEUE.get()
-                topics = msg.topic.split('/')
+        while True:
+            msg = await MSG_QUEUE.get()
+            topics = msg.topic.split('/')
 
-                if topics[0] == HA_TOPIC and topics[-1] == 'command':
-                    await HA_process(topics, msg.payload.decode('utf-8'))
-                elif topics[0] == EW11_TOPIC and topics[-1] == 'recv':
-                    # Que에서 확인된 시간 기준으로 EW11 Health Check함.
-                    last_received_time = time.time()
+            if topics[0] == HA_TOPIC and topics[-1] == 'command':
+                await HA_process(topics, msg.payload.decode('utf-8'))
+            elif topics[0] == EW11_TOPIC and topics[-1] == 'recv':
+                # Que에서 확인된 시간 기준으로 EW11 Health Check함.
+                last_received_time = time.time()
+                
+                if CAPTURE:
+                    CAPTURE.write(CAPTURE_RECORD.pack(msg.timestamp, len(msg.payload)) + msg.payload)
 
-                    await EW11_process(msg.payload.hex().upper())
+                await EW11_process(msg.payload)
+            
+            # msg.timestamp는 수신 시점의 time.monotonic() 값
+            MSG_LATENCY.append(time.monotonic() - msg.timestamp)
                    
     
     # EW11 전달된 메시지 처리
     async def EW11_process(raw_data):
-        nonlocal DISCOVERY_LIST
         nonlocal RESIDUE
         nonlocal MSG_CACHE
         nonlocal DEVICE_STATE       
         
-        raw_data = RESIDUE + raw_data
+        RESIDUE += raw_data
         
         if ew11_log:
-            log('[SIGNAL] receved: {}'.format(raw_data))
+            log('[SIGNAL] receved: %s', HexDump(RESIDUE), category='ew11')
         
-        k = 0
-        cors = []
-        msg_length = len(raw_data)
-        while k < msg_length:
-            # F7로 시작하는 패턴을 패킷으로 분리
-            if raw_data[k:k + 2] == 'F7':
-                # 남은 데이터가 최소 패킷 길이를 만족하지 못하면 RESIDUE에 저장 후 종료
-                if k + 10 > msg_length:
-                    RESIDUE = raw_data[k:]
-                    break
+        if BUS_SLOT_MODE:
+            now = time.monotonic()
+            # 빈 구간이 끝난 시점 (다음 데이터 도착)까지의 길이 기록
+            if BUS_STATS['opened'] is not None:
+                gap = now - BUS_STATS['opened']
+                BUS_STATS['gap'] = gap if BUS_STATS['gap'] is None else BUS_STATS['gap'] * 0.9 + gap * 0.1
+                BUS_STATS['opened'] = None
+        last_state = None
+        
+        # F7로 시작하는 패턴을 패킷으로 분리 (Checksum 확인까지 완료된 패킷만 전달됨)
+        for packet in split_packets(RESIDUE, METRICS):
+            if METRICS:
+                METRICS.frames[packet[1]] = METRICS.frames.get(packet[1], 0) + 1
+                
+            # 월패드 Polling 순서 추적 - 마지막 패킷이 State 응답인지 확인하고 장치별 Polling 주기 기록
+            if BUS_SLOT_MODE:
+                if packet[1] in STATE_HEADER and packet[3] == STATE_HEADER[packet[1]][1]:
+                    last_state = (packet[1], packet[2])
+                    track_bus_poll(last_state, now)
                 else:
-                    data_length = int(raw_data[k + 8:k + 10], 16)
-                    packet_length = 10 + data_length * 2 + 4 
+                    last_state = None
                     
-                    # 남은 데이터가 예상되는 패킷 길이보다 짧으면 RESIDUE에 저장 후 종료
-                    if k + packet_length > msg_length:
-                        RESIDUE = raw_data[k:]
-                        break
-                    else:
-                        packet = raw_data[k:k + packet_length]
-                        
-                # 분리된 패킷이 Valid한 패킷인지 Checksum 확인                
-                if packet != checksum(packet):
-                    k+=1
-                    continue
+            # 전송 중인 Command의 ACK이면 바로 완료 처리
+            if CMD_ACK and packet[3] & 0x80:
+                done = CMD_ACK.get(bytes(packet[0:4]))
+                if done and not done.done():
+                    done.set_result(True)
+            
+            # 처리 대상인 STATE/ACK 패킷만 Decoder가 등록되어 있음
+            decoder = PACKET_DECODER.get(packet[1] << 8 | packet[3])
+            if decoder is None:
+                continue
+            
+            # MSG_CACHE에 없는 새로운 패킷인 경우만 실행
+            header = bytes(packet[0:5])
+            if MSG_CACHE.get(header) == packet[5:]:
+                continue
+            
+            for (name, id1, id2), state, value in decoder(packet):
+                # 처음 확인된 장치는 Discovery Task에 등록 요청 (State 업데이트는 기다리지 않고 진행)
+                queue_discovery(name, id1, id2)
+                
+                if state in LOCAL_STATE:
+                    DEVICE_STATE['{}_{:0>2d}_{:0>2d}{}'.format(name, id1, id2, state)] = value
                 else:
-                    STATE_PACKET = False
-                    ACK_PACKET = False
-                    
-                    # STATE 패킷인지 확인
-                    if packet[2:4] in STATE_HEADER and packet[6:8] in STATE_HEADER[packet[2:4]][1]:
-                        STATE_PACKET = True
-                    # ACK 패킷인지 확인
-                    elif packet[2:4] in ACK_HEADER and packet[6:8] in ACK_HEADER[packet[2:4]][1]:
-                        ACK_PACKET = True
-                    
-                    if STATE_PACKET or ACK_PACKET:
-                        # MSG_CACHE에 없는 새로운 패킷이거나 FORCE_UPDATE 실행된 경우만 실행
-                        if MSG_CACHE.get(packet[0:10]) != packet[10:] or FORCE_UPDATE:
-                            name = STATE_HEADER[packet[2:4]][0]                            
-                            if name == 'light':
-                                # ROOM ID
-                                rid = int(packet[5], 16)
-                                # ROOM의 light 갯수 + 1
-                                slc = int(packet[8:10], 16) 
-                                
-                                for id in range(1, slc):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, id)
-                                        payload['name'] = payload['name'].format(rid, id)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    # State 업데이트까지 진행
-                                    onoff = 'ON' if int(packet[10 + 2 * id: 12 + 2 * id], 16) > 0 else 'OFF'
-                                        
-                                    await update_state(name, 'power', rid, id, onoff)
-                                    
-                                    # 직전 처리 State 패킷은 저장
-                                    if STATE_PACKET:
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                            elif name == 'thermostat':
-                                # room 갯수
-                                rc = int((int(packet[8:10], 16) - 5) / 2)
-                                # room의 조절기 수 (현재 하나 뿐임)
-                                src = 1
-                                
-                                onoff_state = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                away_state = bin(int(packet[14:16], 16))[2:].zfill(8)
-                                
-                                for rid in range(1, rc + 1):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, src)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, src)
-                                        payload['name'] = payload['name'].format(rid, src)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    setT = str(int(packet[16 + 4 * rid:18 + 4 * rid], 16))
-                                    curT = str(int(packet[18 + 4 * rid:20 + 4 * rid], 16))
-                                    
-                                    if onoff_state[8 - rid ] == '1':
-                                        onoff = 'heat'
-                                    # 외출 모드는 off로 
-                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '1':
-                                        onoff = 'off'
-#                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '0':
-#                                        onoff = 'off'
-#                                    else:
-#                                        onoff = 'off'
-
-                                    await update_state(name, 'power', rid, src, onoff)
-                                    await update_state(name, 'curTemp', rid, src, curT)
-                                    await update_state(name, 'setTemp', rid, src, setT)
-                                    
-                                # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # Ack 패킷도 State로 저장
-                                    MSG_CACHE['F7361F810F'] = packet[10:]
-                                        
-                            # plug는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
-                            elif name == 'plug' and STATE_PACKET:
-                                if STATE_PACKET:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    spc = int(packet[10:12], 16) 
-                                
-                                    for id in range(1, spc + 1):
-                                        discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
-
-                                        if discovery_name not in DISCOVERY_LIST:
-                                            DISCOVERY_LIST.append(discovery_name)
-                                    
-                                            for payload_template in DISCOVERY_PAYLOAD[name]:
-                                                payload = payload_template.copy()
-                                                payload['~'] = payload['~'].format(rid, id)
-                                                payload['name'] = payload['name'].format(rid, id)
-                                   
-                                                # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                                await mqtt_discovery(payload)
-                                                await asyncio.sleep(DISCOVERY_DELAY)  
-                                    
-                                        # BIT0: 대기전력 On/Off, BIT1: 자동모드 On/Off
-                                        # 위와 같지만 일단 on-off 여부만 판단
-                                        onoff = 'ON' if int(packet[7 + 6 * id], 16) > 0 else 'OFF'
-                                        autoonoff = 'ON' if int(packet[6 + 6 * id], 16) > 0 else 'OFF'
-                                        power_num = '{:.2f}'.format(int(packet[8 + 6 * id: 12 + 6 * id], 16) / 100)
-                                        
-                                        await update_state(name, 'power', rid, id, onoff)
-                                        await update_state(name, 'auto', rid, id, onoff)
-                                        await update_state(name, 'current', rid, id, power_num)
-                                    
-                                        # 직전 처리 State 패킷은 저장
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    sid = int(packet[10:12], 16) 
-                                
-                                    onoff = 'ON' if int(packet[13], 16) > 0 else 'OFF'
-                                    
-                                    await update_state(name, 'power', rid, id, onoff)
-                                        
-                            elif name == 'gasvalve':
-                                # Gas Value는 하나라서 강제 설정
-                                rid = 1
-                                # Gas Value는 하나라서 강제 설정
-                                spc = 1 
-                                
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, spc)
-                                    
-                                if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                    payload['~'] = payload['~'].format(rid, spc)
-                                    payload['name'] = payload['name'].format(rid, spc)
-                                   
-                                    # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                    await mqtt_discovery(payload)
-                                    await asyncio.sleep(DISCOVERY_DELAY)                                
-
-                                onoff = 'ON' if int(packet[12:14], 16) == 1 else 'OFF'
-                                        
-                                await update_state(name, 'power', rid, spc, onoff)
-                                
-                                # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
-                            
-                            # 일괄차단기 ACK PACKET은 상태 업데이트에 반영하지 않음
-                            elif name == 'batch' and STATE_PACKET:
-                                # 일괄차단기는 하나라서 강제 설정
-                                rid = 1
-                                # 일괄차단기는 하나라서 강제 설정
-                                sbc = 1
-                                
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, sbc)
-                                
-                                if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    for payload_template in DISCOVERY_PAYLOAD[name]:
-                                        payload = payload_template.copy()
-                                        payload['~'] = payload['~'].format(rid, sbc)
-                                        payload['name'] = payload['name'].format(rid, sbc)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)           
-
-                                # 일괄 차단기는 버튼 상태 변수 업데이트
-                                states = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                        
-                                ELEVDOWN = states[2]                                        
-                                ELEVUP = states[3]
-                                GROUPON = states[5]
-                                OUTING = states[6]
-                                                                    
-                                grouponoff = 'ON' if GROUPON == '1' else 'OFF'
-                                outingonoff = 'ON' if OUTING == '1' else 'OFF'
-                                
-                                #ELEVDOWN과 ELEVUP은 직접 DEVICE_STATE에 저장
-                                elevdownonoff = 'ON' if ELEVDOWN == '1' else 'OFF'
-                                elevuponoff = 'ON' if ELEVUP == '1' else 'OFF'
-                                DEVICE_STATE['batch_01_01elevator-up'] = elevuponoff
-                                DEVICE_STATE['batch_01_01elevator-down'] = elevdownonoff
-                                    
-                                # 일괄 조명 및 외출 모드는 상태 업데이트
-                                await update_state(name, 'group', rid, sbc, grouponoff)
-                                await update_state(name, 'outing', rid, sbc, outingonoff)
-                                
-                                MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                RESIDUE = ''
-                k = k + packet_length
+                    update_state(name, state, id1, id2, value)
+            
+            # 직전 처리 State 패킷은 저장, ACK 패킷은 필요한 경우 State로 저장
+            if packet[3] == STATE_HEADER[packet[1]][1]:
+                MSG_CACHE[header] = bytes(packet[5:])
+            elif packet[1] in ACK_CACHE_HEADER:
+                MSG_CACHE[ACK_CACHE_HEADER[packet[1]]] = bytes(packet[5:])
+        
+        # State 응답으로 끝나고 이어지는 데이터가 없으면 다음 Polling 전까지 Bus가 비어 있으므로 대기 중인 명령 전송
+        if last_state is not None and not RESIDUE:
+            BUS_STATS['opened'] = now
+            open_bus_slot(*last_state)
+    
+    
+    # (RS485 ID, GROUP)별 State 응답 간격으로 Polling 주기 추정 (지수 이동 평균)
+    def track_bus_poll(slot, now):
+        poll = BUS_POLL.get(slot)
+        if poll is None:
+            BUS_POLL[slot] = [now, None]
+            return
+        period = now - poll[0]
+        poll[0] = now
+        poll[1] = period if poll[1] is None else poll[1] * 0.9 + period * 0.1
+        
+        
+    # 해당 장치 (같은 GROUP 혹은 전체 GROUP 응답)의 빈 구간을 기다리는 명령을 깨움
+    def open_bus_slot(id, group):
+        waiters = BUS_SLOT_WAITER.get(id)
+        if not waiters:
+            return
+        for target, slot in waiters:
+            if (target == group or group & 0x0F == 0x0F) and not slot.done():
+                slot.set_result(True)
+        BUS_SLOT_WAITER[id] = [waiter for waiter in waiters if not waiter[1].done()]
+    
+    
+    # 대상 장치의 State 응답 직후까지 대기 (응답이 없으면 Polling 주기 혹은 BUS_SLOT_TIMEOUT초 후 진행)
+    async def wait_bus_slot(sendcmd):
+        id, group = int(sendcmd[2:4], 16), int(sendcmd[4:6], 16)
+        poll = BUS_POLL.get((id, group)) or BUS_POLL.get((id, group | 0x0F))
+        timeout = BUS_SLOT_TIMEOUT
+        if poll and poll[1]:
+            timeout = min(timeout, poll[1] * 1.5)
+        
+        slot = asyncio.get_event_loop().create_future()
+        BUS_SLOT_WAITER.setdefault(id, []).append((group, slot))
+        try:
+            await asyncio.wait_for(slot, timeout)
+            BUS_STATS['slot'] += 1
+        except asyncio.TimeoutError:
+            BUS_STATS['timeout'] += 1
+            if id in BUS_SLOT_WAITER:
+                BUS_SLOT_WAITER[id] = [waiter for waiter in BUS_SLOT_WAITER[id] if waiter[1] is not slot]
                 
-            else:
-                k+=1
+    
+    # 처음 확인된 장치의 Discovery Payload를 Discovery Queue에 등록
+    def queue_discovery(name, id1, id2):
+        if (name, id1, id2) not in DISCOVERY_LIST:
+            DISCOVERY_LIST.add((name, id1, id2))
+            
+            for payload_template in DISCOVERY_PAYLOAD[name]:
+                payload = payload_template.copy()
+                payload['~'] = payload['~'].format(id1, id2)
+                payload['name'] = payload['name'].format(id1, id2)
                 
+                DISCOVERY_QUEUE.put_nowait(payload)
+    
     
     # MQTT Discovery로 장치 자동 등록
     async def mqtt_discovery(payload):
@@ -596,29 +1013,134 @@ def ezville_loop(config):
         payload['device'] = DISCOVERY_DEVICE
         payload['uniq_id'] = payload['name']
 
-        # Discovery에 등록
+        # Discovery에 등록 (HA 재시작 시에도 유지되도록 retain)
         topic = 'homeassistant/{}/ezville_wallpad/{}/config'.format(intg, payload['name'])
         log('[INFO] 장치 등록:  {}'.format(topic))
-        mqtt_client.publish(topic, json.dumps(payload))
+        mqtt_client.publish(topic, json.dumps(payload), retain=True)
+    
+    
+    # Discovery Queue에 등록된 장치를 DISCOVERY_DELAY초 간격으로 등록 (패킷 처리와 별도로 동작)
+    async def discovery_loop():
+        while True:
+            payload = await DISCOVERY_QUEUE.get()
+            await mqtt_discovery(payload)
+            
+            # 장치 등록 후 DISCOVERY_DELAY초 후에 그 사이 먼저 Publish된 State를 다시 전달
+            await asyncio.sleep(DISCOVERY_DELAY)
+            
+            deviceID = payload['~'].split('/')[1]
+            for value in payload.values():
+                if isinstance(value, str) and value.startswith('~/') and value.endswith('/state'):
+                    state = value[2:-6]
+                    if deviceID + state in DEVICE_STATE:
+                        mqtt_client.publish(STATE_TOPIC.format(deviceID, state), DEVICE_STATE[deviceID + state].encode())
 
     
+    # 처음 나온 장치 속성의 DEVICE_STATE key와 State Topic을 만들어 STATE_ENTRY에 저장
+    def state_entry(device, state, id1, id2):
+        entry = STATE_ENTRY.get((device, state, id1, id2))
+        
+        if entry is None:
+            deviceID = '{}_{:0>2d}_{:0>2d}'.format(device, id1, id2)
+            key = sys.intern(deviceID + state)
+            entry = [key, sys.intern(STATE_TOPIC.format(deviceID, state)), DEVICE_STATE.get(key)]
+            STATE_ENTRY[(device, state, id1, id2)] = entry
+        
+        return entry
+    
+    
+    # 저장 중 종료되어도 이전 파일이 깨지지 않도록 임시 파일에 쓴 뒤 교체
+    def save_snapshot():
+        snapshot = {
+            'version': 1,
+            'discovery': sorted(DISCOVERY_LIST),
+            'state': [list(entry_key) + [entry[2]] for entry_key, entry in STATE_ENTRY.items() if entry[2] is not None],
+            'cache': {header.hex(): data.hex() for header, data in MSG_CACHE.items()}
+        }
+        
+        temp_file = SNAPSHOT_FILE + '.tmp'
+        try:
+            with open(temp_file, 'w') as file:
+                json.dump(snapshot, file, separators=(',', ':'))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, SNAPSHOT_FILE)
+        except OSError as e:
+            log('[ERROR] 장치 State 저장 실패: {}'.format(e))
+    
+    
+    def load_snapshot():
+        try:
+            with open(SNAPSHOT_FILE) as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log('[WARNING] 저장된 장치 State를 읽지 못했습니다. 처음부터 다시 등록합니다. ({})'.format(e))
+            return
+        if snapshot.get('version') != 1:
+            return
+        
+        DISCOVERY_LIST.update(tuple(device) for device in snapshot['discovery'])
+        for device, state, id1, id2, value in snapshot['state']:
+            entry = state_entry(device, state, id1, id2)
+            entry[2] = value
+            DEVICE_STATE[entry[0]] = value
+        for header, data in snapshot['cache'].items():
+            MSG_CACHE[bytes.fromhex(header)] = bytes.fromhex(data)
+        
+        log('[INFO] 저장된 장치 State 불러오기: 장치 {}개, State {}개'.format(len(DISCOVERY_LIST), len(snapshot['state'])))
+        
+        
+    async def snapshot_loop():
+        while True:
+            await asyncio.sleep(SNAPSHOT_PERIOD)
+            save_snapshot()
+            
+    
     # 장치 State를 MQTT로 Publish
-    async def update_state(device, state, id1, id2, value):
-        nonlocal DEVICE_STATE
-
-        deviceID = '{}_{:0>2d}_{:0>2d}'.format(device, id1, id2)
-        key = deviceID + state
+    def update_state(device, state, id1, id2, value):
+        entry = STATE_ENTRY.get((device, state, id1, id2)) or state_entry(device, state, id1, id2)
         
-        if value != DEVICE_STATE.get(key) or FORCE_UPDATE:
+        if value != entry[2]:
+            key, topic, _ = entry
+            
+            # 수치 센서는 Publish 조건이 안 되면 보류 (state_update_loop에서 조건이 되면 Publish)
+            deadband = NUMERIC_DEADBAND.get((device, state))
+            if deadband is not None:
+                now = time.monotonic()
+                if entry[2] is not None and not numeric_due((device, state, id1, id2), deadband, entry[2], value, now):
+                    DEVICE_STATE[key] = value
+                    NUMERIC_PENDING[(device, state, id1, id2)] = value
+                    return
+                NUMERIC_PENDING.pop((device, state, id1, id2), None)
+                NUMERIC_PUBLISHED[(device, state, id1, id2)] = now
+            
+            entry[2] = value
             DEVICE_STATE[key] = value
             
-            topic = STATE_TOPIC.format(deviceID, state)
-            mqtt_client.publish(topic, value.encode())
+            # 목표 State에 도달한 Command가 있으면 완료 처리
+            if CMD_TARGET:
+                target = CMD_TARGET.get(key)
+                if target and target[0] == value and not target[1].done():
+                    target[1].set_result(True)
+            
+            mqtt_client.publish(topic, STATE_PAYLOAD.get(value) or value.encode())
                     
             if mqtt_log:
-                log('[LOG] ->> HA : {} >> {}'.format(topic, value))
+                log('[LOG] ->> HA : %s >> %s', topic, value, category='mqtt')
+        
+        # 보류 중에 마지막 Publish 값으로 돌아온 경우
+        elif NUMERIC_PENDING and NUMERIC_PENDING.pop((device, state, id1, id2), None) is not None:
+            DEVICE_STATE[entry[0]] = value
 
         return
+    
+    
+    # 마지막 Publish 후 최대 간격이 지났거나, 최소 간격이 지났고 변화폭 이상 바뀌었으면 Publish
+    def numeric_due(state_key, deadband, published, value, now):
+        elapsed = now - NUMERIC_PUBLISHED.get(state_key, 0)
+        return elapsed >= NUMERIC_MAX_INTERVAL or (elapsed >= NUMERIC_MIN_INTERVAL and abs(float(value) - float(published)) >= deadband)
 
     
     # HA에서 전달된 메시지 처리        
@@ -629,7 +1151,7 @@ def ezville_loop(config):
         device = device_info[0]
         
         if mqtt_log:
-            log('[LOG] HA ->> : {} -> {}'.format('/'.join(topics), value))
+            log('[LOG] HA ->> : %s -> %s', '/'.join(topics), value, category='mqtt')
 
         if device in RS485_DEVICE:
             key = topics[1] + topics[2]
@@ -637,8 +1159,10 @@ def ezville_loop(config):
             sid = int(device_info[2])
             cur_state = DEVICE_STATE.get(key)
             
+            # 현재 상태로 되돌리는 명령이면 아직 전송되지 않은 이전 명령만 취소
             if value == cur_state:
-                pass
+                if CMD_QUEUE.discard(key) and debug:
+                    log('[DEBUG] Cancelled ::: %s (coalesced: %s)', key, CMD_QUEUE.coalesced, category='debug')
             
             else:
                 if device == 'thermostat':                        
@@ -669,7 +1193,7 @@ def ezville_loop(config):
 #                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})                    
                                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
                                     
                     elif topics[2] == 'setTemp':                            
                         value = int(float(value))
@@ -681,7 +1205,7 @@ def ezville_loop(config):
                         await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
 
 #                    elif device == 'Fan':
 #                        if topics[2] == 'power':
@@ -711,7 +1235,7 @@ def ezville_loop(config):
                     await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
                                 
                 elif device == 'plug':                         
                     pwr = '01' if value == 'ON' else '00'
@@ -723,7 +1247,7 @@ def ezville_loop(config):
                     await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
                                 
                 elif device == 'gasvalve':
                     # 가스 밸브는 ON 제어를 받지 않음
@@ -735,7 +1259,7 @@ def ezville_loop(config):
                         await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                                
                         if debug:
-                            log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                            log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
                                 
                 elif device == 'batch':
                     # Batch는 Elevator 및 외출/그룹 조명 버튼 상태 고려 
@@ -768,53 +1292,99 @@ def ezville_loop(config):
                     await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
                     
                     if debug:
-                        log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        log('[DEBUG] Queued ::: sendcmd: %s, recvcmd: %s, statcmd: %s', sendcmd, recvcmd, statcmd, category='debug')
   
                                                 
     # HA에서 전달된 명령을 EW11 패킷으로 전송
     async def send_to_ew11(send_data):
+        # Ack나 State 업데이트가 가능한 경우 완료 시점을 받을 Future 등록
+        key, value = send_data['statcmd']
+        done = None
+        acks = []
+        if value != 'NULL':
+            done = asyncio.get_event_loop().create_future()
+            recvcmd = send_data['recvcmd'] if isinstance(send_data['recvcmd'], list) else [send_data['recvcmd']]
+            acks = [bytes.fromhex(ack) for ack in recvcmd]
+            for ack in acks:
+                CMD_ACK[ack] = done
+            CMD_TARGET[key] = (value, done)
             
+        try:
+            # ACK 지연은 마지막 전송 시점부터 계산 (Bus 빈 구간 대기 및 이전 재전송 간격은 제외)
+            sent = await send_until_done(send_data, done)
+            if METRICS and done is not None:
+                METRICS.observe_command(done.done() or DEVICE_STATE.get(key) == value, time.monotonic() - sent if sent else 0)
+        finally:
+            for ack in acks:
+                if CMD_ACK.get(ack) is done:
+                    CMD_ACK.pop(ack)
+            if done and CMD_TARGET.get(key, (None, None))[1] is done:
+                CMD_TARGET.pop(key)
+
+        
+    # ACK 혹은 목표 State를 받을 때까지 명령 재전송, 마지막으로 전송한 시각 반환 (한번도 전송하지 못했으면 None)
+    async def send_until_done(send_data, done):
+        sent = None
         for i in range(CMD_RETRY_COUNT):
+            if METRICS and i:
+                METRICS.retries += 1
+            
+            if BUS_SLOT_MODE:
+                await wait_bus_slot(send_data['sendcmd'])
+            
             if ew11_log:
-                log('[SIGNAL] 신호 전송: {}'.format(send_data))
+                log('[SIGNAL] 신호 전송: %s', send_data, category='ew11')
                         
             if comm_mode == 'mqtt':
                 mqtt_client.publish(EW11_SEND_TOPIC, bytes.fromhex(send_data['sendcmd']))
             else:
-                nonlocal soc
+                # 재연결 중이면 연결될 때까지 기다린 후 전송, 전송 실패 시 재연결하고 다음 차례에 재전송
+                await SOC_CONNECTED.wait()
+                writer = soc_writer
                 try:
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
+                    async with SEND_LOCK:
+                        writer.write(bytes.fromhex(send_data['sendcmd']))
+                        await writer.drain()
                 except OSError:
-                    soc.close()
-                    soc = initiate_socket(soc)
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
+                    await reconnect_socket(writer)
+                    continue
+            sent = time.monotonic()
             if debug:                     
-                log('[DEBUG] Iter. No.: ' + str(i + 1) + ', Target: ' + send_data['statcmd'][1] + ', Current: ' + DEVICE_STATE.get(send_data['statcmd'][0]))
+                log('[DEBUG] Iter. No.: %s, Target: %s, Current: %s', i + 1, send_data['statcmd'][1], DEVICE_STATE.get(send_data['statcmd'][0]), category='debug')
              
             # Ack나 State 업데이트가 불가한 경우 한번만 명령 전송 후 Return
-            if send_data['statcmd'][1] == 'NULL':
-                return
+            if done is None:
+                return sent
       
-            # FIRST_WAITTIME초는 ACK 처리를 기다림 (초당 30번 데이터가 들어오므로 ACK 못 받으면 후속 처리 시작)
+            # 처음에는 FIRST_WAITTIME초까지 ACK 처리를 기다림 (초당 30번 데이터가 들어오므로 ACK 못 받으면 후속 처리 시작)
             if i == 0:
-                await asyncio.sleep(FIRST_WAITTIME)
-            # 이후에는 정해진 간격 혹은 Random Backoff 시간 간격을 주고 ACK 확인
+                timeout = FIRST_WAITTIME
+            # 이후에는 정해진 간격 혹은 Random Backoff 시간까지 ACK를 기다림
             else:
                 if RANDOM_BACKOFF:
-                    await asyncio.sleep(random.randint(0, int(CMD_INTERVAL * 1000))/1000)    
+                    timeout = random.randint(0, int(CMD_INTERVAL * 1000))/1000
                 else:
-                    await asyncio.sleep(CMD_INTERVAL)
+                    timeout = CMD_INTERVAL
+            
+            # ACK 혹은 목표 State가 도착하면 대기 시간이 남아 있어도 바로 완료
+            try:
+                await asyncio.wait_for(asyncio.shield(done), timeout)
+                return sent
+            except asyncio.TimeoutError:
+                pass
               
             if send_data['statcmd'][1] == DEVICE_STATE.get(send_data['statcmd'][0]):
-                return
+                return sent
 
         if ew11_log:
             log('[SIGNAL] {}회 명령을 재전송하였으나 수행에 실패했습니다.. 다음의 Queue 삭제: {}'.format(str(CMD_RETRY_COUNT),send_data))
-            return
+        return sent
         
                                                 
     # EW11 동작 상태를 체크해서 필요시 리셋 실시
     async def ew11_health_loop():        
+        nonlocal restart_flag
+        
         while True:
             timestamp = time.time()
         
@@ -826,27 +1396,30 @@ def ezville_loop(config):
                     
                     restart_flag = True
 
-                except:
-                    log('[ERROR] 기기 재시작 오류! 기기 상태를 확인하세요.')
+                except Exception as e:
+                    log('[ERROR] 기기 재시작 오류! 기기 상태를 확인하세요. ({})'.format(repr(e)))
             else:
                 log('[INFO] EW11 연결 상태 문제 없음')
             await asyncio.sleep(EW11_TIMEOUT)        
 
                                                 
-    # Telnet 접속하여 EW11 리셋        
+    # HTTP (설정 시) 혹은 Telnet 접속하여 EW11 리셋        
     async def reset_EW11(): 
         ew11_id = config['ew11_id']
         ew11_password = config['ew11_password']
         ew11_server = config['ew11_server']
-
-        ew11 = telnetlib.Telnet(ew11_server)
-
-        ew11.read_until(b'login:')
-        ew11.write(ew11_id.encode('utf-8') + b'\n')
-        ew11.read_until(b'password:')
-        ew11.write(ew11_password.encode('utf-8') + b'\n')
-        ew11.write('Restart'.encode('utf-8') + b'\n')
-        ew11.read_until(b'Restart..')
+        
+        # HTTP 재시작을 먼저 시도하고 실패하면 Telnet으로 리셋
+        reset_done = False
+        if EW11_HTTP_RESET:
+            try:
+                await reset_ew11_http(ew11_server, ew11_id, ew11_password, EW11_HTTP_RESET_PATH, EW11_RESET_TIMEOUT)
+                reset_done = True
+            except (OSError, asyncio.TimeoutError) as e:
+                log('[WARNING] EW11 HTTP 재시작 실패, Telnet으로 재시도합니다. ({})'.format(repr(e)))
+        
+        if not reset_done:
+            await reset_ew11_telnet(ew11_server, ew11_id, ew11_password, EW11_RESET_TIMEOUT)
         
         log('[INFO] EW11 리셋 완료')
         
@@ -854,127 +1427,261 @@ def ezville_loop(config):
         await asyncio.sleep(60)
         
     
-    def initiate_socket():
+    async def initiate_socket():
         # SOCKET 통신 시작
         log('[INFO] Socket 연결을 시작합니다')
             
         retry_count = 0
         while True:
             try:
-                soc = socket.socket()
-                soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                connect_socket(soc)
-                return soc
-            except ConnectionRefusedError as e:
-                log('[ERROR] Server에서 연결을 거부합니다. 재시도 예정 (' + str(retry_count) + '회 재시도)')
-                time.sleep(1)
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(SOC_ADDRESS, SOC_PORT), SOC_CONNECT_TIMEOUT)
+                writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                SOC_CONNECTED.set()
+                return reader, writer
+            except (OSError, asyncio.TimeoutError) as e:
+                # 재시도 간격을 지수적으로 늘리고, 무작위로 줄여 재시도가 한 시점에 몰리지 않도록 함
+                delay = min(SOC_BACKOFF_MAX, 2 ** min(retry_count, 16)) * random.uniform(0.5, 1)
+                log('[ERROR] Socket 연결 실패 ({}). {:.1f}초 후 재시도 예정 ({}회 재시도)'.format(str(e) or '연결 시간 초과', delay, retry_count))
+                await asyncio.sleep(delay)
                 retry_count += 1
-                continue
              
             
-    def connect_socket(socket):
-        socket.connect((SOC_ADDRESS, SOC_PORT))
+    # 송신/수신 중 오류가 난 연결을 닫고 재연결 (이미 다른 Task가 재연결한 경우 생략)
+    async def reconnect_socket(old_writer):
+        nonlocal soc_reader
+        nonlocal soc_writer
+        
+        async with SOC_LOCK:
+            if soc_writer is old_writer:
+                SOC_CONNECTED.clear()
+                down_time = time.time()
+                soc_writer.close()
+                soc_reader, soc_writer = await initiate_socket()
+                
+                down_time = time.time() - down_time
+                SOC_STATS['reconnect'] += 1
+                SOC_STATS['downtime'] += down_time
+                log('[INFO] Socket 재연결 완료 ({:.1f}초 끊김, 누적 {}회 / {:.1f}초)'.format(down_time, SOC_STATS['reconnect'], SOC_STATS['downtime']))
     
 
     async def serial_recv_loop():
-        nonlocal soc
-        nonlocal MSG_QUEUE
-        
         class MSG:
             topic = ''
             payload = bytearray()
-        
-        msg = MSG()
+            timestamp = 0
         
         while True:
+            await SOC_CONNECTED.wait()
+            writer = soc_writer
             try:
-                # EW11 버퍼 크기만큼 데이터 받기
-                DATA = soc.recv(EW11_BUFFER_SIZE)
+                # EW11 버퍼 크기까지 데이터가 도착하는 대로 받기
+                DATA = await soc_reader.read(EW11_BUFFER_SIZE)
+                if not DATA:
+                    raise ConnectionResetError('EW11 연결 종료')
+                if METRICS:
+                    METRICS.recv_bytes += len(DATA)
+                
+                msg = MSG()
                 msg.topic = EW11_TOPIC + '/recv'
                 msg.payload = DATA   
+                msg.timestamp = time.monotonic()
                 
-                MSG_QUEUE.put(msg)
+                MSG_QUEUE.put_nowait(msg)
                 
             except OSError:
-                soc.close()
-                soc = initiate_socket(soc)
-         
-            await asyncio.sleep(SERIAL_RECV_DELAY) 
+                await reconnect_socket(writer)
         
         
     async def state_update_loop():
-        nonlocal force_target_time
-        nonlocal force_stop_time
-        nonlocal FORCE_UPDATE
+        latency_report_time = time.time() + LATENCY_REPORT_PERIOD
         
         while True:
-            await process_message()                    
-            
             timestamp = time.time()
             
-            # 정해진 시간이 지나면 FORCE 모드 발동
-            if timestamp > force_target_time and not FORCE_UPDATE and FORCE_MODE:
-                force_stop_time = timestamp + FORCE_DURATION
-                FORCE_UPDATE = True
-                log('[INFO] 상태 강제 업데이트 실시')
-                
-            # 정해진 시간이 지나면 FORCE 모드 종료    
-            if timestamp > force_stop_time and FORCE_UPDATE and FORCE_MODE:
-                force_target_time = timestamp + FORCE_PERIOD
-                FORCE_UPDATE = False
-                log('[INFO] 상태 강제 업데이트 종료')
+            # 메시지 처리 지연 시간 통계 출력
+            if debug and timestamp > latency_report_time:
+                latency_report_time = timestamp + LATENCY_REPORT_PERIOD
+                samples = sorted(MSG_LATENCY)
+                log('[DEBUG] 메시지 처리 지연 ({}건): p50 {:.1f}ms, p99 {:.1f}ms'.format(len(samples), percentile(samples, 50) * 1000, percentile(samples, 99) * 1000))
+                if BUS_SLOT_MODE:
+                    log('[DEBUG] 빈 구간 전송 {}회, 대기 초과 전송 {}회, 평균 빈 구간 {}'.format(BUS_STATS['slot'], BUS_STATS['timeout'], 'N/A' if BUS_STATS['gap'] is None else '{:.1f}ms'.format(BUS_STATS['gap'] * 1000)))
+                if comm_mode == 'mixed' or comm_mode == 'socket':
+                    log('[DEBUG] Socket 재연결 {}회, 누적 끊김 {:.1f}초'.format(SOC_STATS['reconnect'], SOC_STATS['downtime']))
                 
+            # 보류 중인 수치 센서 값 중 Publish 조건이 된 값 전달 (같은 패킷이 반복되면 update_state가 다시 불리지 않으므로)
+            if NUMERIC_PENDING:
+                now = time.monotonic()
+                for state_key, value in list(NUMERIC_PENDING.items()):
+                    if numeric_due(state_key, NUMERIC_DEADBAND[state_key[:2]], STATE_ENTRY[state_key][2], value, now):
+                        update_state(*state_key, value)
+            
             # STATE_LOOP_DELAY 초 대기 후 루프 진행
             await asyncio.sleep(STATE_LOOP_DELAY)
             
             
+    # 저장된 State를 일정한 속도로 하나씩 다시 Publish (한번에 몰아서 보내지 않음)
+    async def force_update_loop():
+        while True:
+            # 이번 주기에 전달할 State 목록 (새로 추가된 장치는 다음 주기부터 포함)
+            entries = [entry for entry in STATE_ENTRY.values() if entry[2] is not None]
+            if not entries:
+                await asyncio.sleep(FORCE_PERIOD)
+                continue
+            
+            interval = max(FORCE_PERIOD / len(entries), 1 / FORCE_RATE)
+            if debug:
+                log('[DEBUG] 상태 강제 업데이트: {}개 State를 {:.2f}초 간격으로 전달'.format(len(entries), interval))
+            
+            for entry in entries:
+                # 전달 시점의 최신 값을 Publish
+                key, topic, value = entry
+                mqtt_client.publish(topic, STATE_PAYLOAD.get(value) or value.encode())
+                
+                await asyncio.sleep(interval)
+            
+            
     async def command_loop():
-        nonlocal CMD_QUEUE
+        slots = asyncio.Semaphore(CMD_CONCURRENCY)
         
         while True:
-            if not CMD_QUEUE.empty():
-                send_data = await CMD_QUEUE.get()
-                await send_to_ew11(send_data)               
+            # 동시 진행 수 여유가 있으면, 전송 중이 아닌 장치의 새 명령을 바로 전송 시작 (완료는 기다리지 않음)
+            await slots.acquire()
+            send_data = await CMD_QUEUE.get(CMD_INFLIGHT)
+            device = send_data['sendcmd'][2:6]
+            CMD_INFLIGHT.add(device)
+            CMD_TASKS.add(asyncio.ensure_future(command_task(send_data, device, slots)))
             
-            # COMMAND_LOOP_DELAY 초 대기 후 루프 진행
+            # 연속 명령 사이에는 COMMAND_LOOP_DELAY 초 대기
             await asyncio.sleep(COMMAND_LOOP_DELAY)    
+            
+            
+    # 명령 하나를 완료(혹은 재시도 초과)까지 진행하고 장치 및 동시 진행 수를 반납
+    async def command_task(send_data, device, slots):
+        try:
+            await send_to_ew11(send_data)
+        except Exception as e:
+            log('[ERROR] 명령 전송 중 오류: {}, {}'.format(send_data, e))
+        finally:
+            CMD_INFLIGHT.discard(device)
+            CMD_TASKS.discard(asyncio.current_task())
+            slots.release()
+            CMD_QUEUE.wake()
  
 
-    # EW11 재실행 시 리스타트 실시
+    # 통계 조회 시점의 Queue 길이 등
+    def metrics_gauges():
+        return {'msg_queue': MSG_QUEUE.qsize(),
+                'cmd_queue': CMD_QUEUE.qsize(),
+                'commands_queued_total': CMD_QUEUE.queued,
+                'commands_coalesced_total': CMD_QUEUE.coalesced,
+                'cmd_inflight': len(CMD_INFLIGHT),
+                'discovered': len(DISCOVERY_LIST),
+                'socket_reconnects': SOC_STATS['reconnect'],
+                'socket_downtime_seconds': round(SOC_STATS['downtime'], 1)}
+    
+    
+    # Prometheus 등에서 METRICS_PORT로 요청하면 통계 응답 (요청 경로는 구분하지 않음)
+    async def metrics_http(reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            body = METRICS.render(metrics_gauges()).encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+    
+    
+    # METRICS_PERIOD초마다 통계를 METRICS_TOPIC으로 전달
+    async def metrics_mqtt_loop():
+        frames_before = {}
+        timestamp = time.monotonic()
+        while True:
+            await asyncio.sleep(METRICS_PERIOD)
+            now = time.monotonic()
+            payload = METRICS.snapshot(metrics_gauges(), frames_before, now - timestamp)
+            mqtt_client.publish(METRICS_TOPIC, json.dumps(payload))
+            frames_before = dict(METRICS.frames)
+            timestamp = now
+            
+            
+    # EW11 재시작 혹은 HA 재시작 시 통신만 재연결 (장치 State 및 Cache는 유지)
     async def restart_control():
-        nonlocal mqtt_client
         nonlocal restart_flag
-        nonlocal MQTT_ONLINE
+        nonlocal RESIDUE
+        nonlocal last_received_time
         
         while True:
-            if restart_flag or (not MQTT_ONLINE and ADDON_STARTED and REBOOT_CONTROL):
-                if restart_flag:
-                    log('[WARNING] EW11 재시작 확인')
-                elif not MQTT_ONLINE and ADDON_STARTED and REBOOT_CONTROL:
-                    log('[WARNING] 동작 중 MQTT Integration Offline 변경')
-                
-                # Asyncio Loop 획득
-                loop = asyncio.get_event_loop()
+            if restart_flag:
+                log('[WARNING] EW11 재시작 확인, EW11 연결을 다시 시작합니다')
+                restart_flag = False
                 
-                # MTTQ 및 socket 연결 종료
-                log('[WARNING] 모든 통신 종료')
-                mqtt_client.loop_stop()
+                # 이전 연결에서 받다 만 패킷은 버림
+                RESIDUE = bytearray()
                 if comm_mode == 'mixed' or comm_mode == 'socket':
-                    nonlocal soc
-                    soc.close()
-                       
-                # flag 원복
-                restart_flag = False
-                MQTT_ONLINE = False
-
-                # asyncio loop 종료
-                log('[WARNING] asyncio loop 종료')
-                loop.stop()
+                    await reconnect_socket(soc_writer)
+                last_received_time = time.time()
+                    
+            elif not MQTT_ONLINE and ADDON_STARTED and REBOOT_CONTROL:
+                log('[WARNING] 동작 중 MQTT Integration Offline 변경, 다시 Online이 될 때까지 대기합니다')
+                
+                # Offline 시점에 HA로 전달된 State 기록
+                published = {entry[0]: entry[2] for entry in STATE_ENTRY.values()}
+                
+                while not MQTT_ONLINE:
+                    await asyncio.sleep(RESTART_CHECK_DELAY)
+                
+                # 필요시 HA 정상화를 위해 Delay 부여
+                await asyncio.sleep(startup_delay)
+                
+                # Offline 동안 바뀐 State만 다시 전달 (나머지는 강제 업데이트 주기에 따라 전달됨)
+                # 강제 업데이트를 사용하지 않으면 HA가 State를 모르므로 전체 전달
+                changed = [entry for entry in STATE_ENTRY.values() if entry[2] is not None and (not FORCE_MODE or published.get(entry[0]) != entry[2])]
+                log('[INFO] MQTT Integration Online 복귀, 변경된 State {}개 전달'.format(len(changed)))
+                for key, topic, value in changed:
+                    mqtt_client.publish(topic, STATE_PAYLOAD.get(value) or value.encode())
             
             # RESTART_CHECK_DELAY초 마다 실행
             await asyncio.sleep(RESTART_CHECK_DELAY)
 
         
+    # 기록된 EW11 데이터를 EW11_process로 바로 전달 (realtime이면 기록된 간격대로, 아니면 최대한 빠르게)
+    async def replay_capture(path, realtime):
+        chunks = read_capture(path)
+        
+        # 전체 패킷 수는 측정 전에 따로 계산
+        buffer = bytearray()
+        frames = 0
+        for timestamp, data in chunks:
+            buffer += data
+            for packet in split_packets(buffer):
+                frames += 1
+        
+        log('[INFO] 재생 시작: {} ({}개 수신 데이터, {}개 패킷)'.format(path, len(chunks), frames))
+        cpu_time = time.process_time()
+        start = time.monotonic()
+        previous = chunks[0][0] if chunks else 0
+        
+        for timestamp, data in chunks:
+            if realtime and timestamp > previous:
+                await asyncio.sleep(timestamp - previous)
+            previous = timestamp
+            await EW11_process(data)
+        
+        elapsed = max(time.monotonic() - start, 1e-9)
+        result = {'chunks': len(chunks), 'frames': frames, 'publishes': mqtt_client.count,
+                  'elapsed': elapsed, 'cpu_time': time.process_time() - cpu_time,
+                  'frames_per_sec': frames / elapsed, 'publishes_per_sec': mqtt_client.count / elapsed}
+        log('[INFO] 재생 완료: {:.3f}초 (CPU {:.3f}초), 패킷 {:.0f}개/초, Publish {:.0f}개/초'.format(result['elapsed'], result['cpu_time'], result['frames_per_sec'], result['publishes_per_sec']))
+        return result
+    
+    
+    if replay is not None:
+        mqtt_client = PublishCounter()
+        return asyncio.get_event_loop().run_until_complete(replay_capture(*replay))
+    
+    
     # MQTT 통신
     mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, 'mqtt-ezville')
     mqtt_client.username_pw_set(config['mqtt_id'], config['mqtt_password'])
@@ -983,66 +1690,84 @@ def ezville_loop(config):
     mqtt_client.on_message = on_message
     mqtt_client.connect_async(config['mqtt_server'])
     
-    # asyncio loop 획득 및 EW11 오류시 재시작 task 등록
+    # asyncio loop 획득 및 EW11 오류시 재연결 task 등록
     loop = asyncio.get_event_loop()
     loop.create_task(restart_control())
         
-    # Discovery 및 강제 업데이트 시간 설정
-    force_target_time = time.time() + FORCE_PERIOD
-    force_stop_time = force_target_time + FORCE_DURATION
-    
-
-    while True:
-        # MQTT 통신 시작
-        mqtt_client.loop_start()
-        # MQTT Integration의 Birth/Last Will Testament를 기다림 (1초 단위)
-        while not MQTT_ONLINE and REBOOT_CONTROL:
-            log('[INFO] Waiting for MQTT connection')
-            time.sleep(1)
-        
-        # socket 통신 시작       
-        if comm_mode == 'mixed' or comm_mode == 'socket':
-            soc = initiate_socket()  
 
-        log('[INFO] 장치 등록 및 상태 업데이트를 시작합니다')
+    # MQTT 통신 시작
+    mqtt_client.loop_start()
+    # MQTT Integration의 Birth/Last Will Testament를 기다림 (1초 단위)
+    while not MQTT_ONLINE and REBOOT_CONTROL:
+        log('[INFO] Waiting for MQTT connection')
+        time.sleep(1)
+    
+    # socket 통신 시작       
+    if comm_mode == 'mixed' or comm_mode == 'socket':
+        soc_reader, soc_writer = loop.run_until_complete(initiate_socket())
 
-        tasklist = []
- 
-        # 필요시 Discovery 등의 지연을 위해 Delay 부여 
-        time.sleep(startup_delay)      
-  
-        # socket 데이터 수신 loop 실행
-        if comm_mode == 'socket':
-            tasklist.append(loop.create_task(serial_recv_loop()))
-        # EW11 패킷 기반 state 업데이트 loop 실행
-        tasklist.append(loop.create_task(state_update_loop()))
-        # Home Assistant 명령 실행 loop 실행
-        tasklist.append(loop.create_task(command_loop()))
-        # EW11 상태 체크 loop 실행
-        tasklist.append(loop.create_task(ew11_health_loop()))
-        
-        # ADDON 정상 시작 Flag 설정
-        ADDON_STARTED = True
-        loop.run_forever()
-        
-        # 이전 task는 취소
-        log('[INFO] 이전 실행 Task 종료')
-        for task in tasklist:
-            task.cancel()
+    log('[INFO] 장치 등록 및 상태 업데이트를 시작합니다')
+    
+    # 이전 실행에서 저장된 장치 목록 및 State 불러오기
+    if SNAPSHOT_PERIOD > 0:
+        load_snapshot()
 
-        ADDON_STARTED = False
-        
-        # 주요 변수 초기화    
-        MSG_QUEUE = Queue()
-        CMD_QUEUE = asyncio.Queue()
-        DEVICE_STATE = {}
-        MSG_CACHE = {}
-        DISCOVERY_LIST = []
-        RESIDUE = ''
+    # 필요시 Discovery 등의 지연을 위해 Delay 부여 
+    time.sleep(startup_delay)      
+
+    # socket 데이터 수신 loop 실행
+    if comm_mode == 'socket':
+        loop.create_task(serial_recv_loop())
+    # MQTT Discovery 등록 loop 실행
+    loop.create_task(discovery_loop())
+    # EW11 및 HA 메시지 처리 loop 실행
+    loop.create_task(process_message())
+    # 메시지 처리 통계 loop 실행
+    loop.create_task(state_update_loop())
+    # 주기적 State 강제 업데이트 loop 실행
+    if FORCE_MODE:
+        loop.create_task(force_update_loop())
+    # Home Assistant 명령 실행 loop 실행
+    loop.create_task(command_loop())
+    # EW11 상태 체크 loop 실행
+    loop.create_task(ew11_health_loop())
+    # 동작 통계 제공 시작
+    if METRICS_MODE == 'http':
+        loop.run_until_complete(asyncio.start_server(metrics_http, port=METRICS_PORT))
+    elif METRICS_MODE == 'mqtt':
+        loop.create_task(metrics_mqtt_loop())
+    # 장치 State 주기적 저장 loop 실행 (애드온 종료 시에도 저장)
+    if SNAPSHOT_PERIOD > 0:
+        loop.create_task(snapshot_loop())
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    
+    # ADDON 정상 시작 Flag 설정
+    ADDON_STARTED = True
+    loop.run_forever()
+    
+    if SNAPSHOT_PERIOD > 0:
+        save_snapshot()
+        log('[INFO] 장치 State 저장 후 종료합니다')
 
 
 if __name__ == '__main__':
-    with open(config_dir + '/options.json') as file:
-        CONFIG = json.load(file)
+    # python ezville.py replay <기록 파일> [--realtime] : 기록된 EW11 데이터로 패킷 처리 성능 측정
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['replay'])
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--realtime', action='store_true', help='기록된 수신 간격대로 재생')
+    parser.add_argument('--options', default=config_dir + '/options.json', help='애드온 설정 파일 (없으면 config.json의 기본값 사용)')
+    args = parser.parse_args()
+    
+    if os.path.exists(args.options):
+        with open(args.options) as file:
+            CONFIG = json.load(file)
+    else:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as file:
+            CONFIG = json.load(file)['options']
     
-    ezville_loop(CONFIG)
+    if args.command == 'replay':
+        CONFIG['ew11_capture_file'] = ''
+        ezville_loop(CONFIG, (args.capture, args.realtime))
+    else:
+        ezville_loop(CONFIG)
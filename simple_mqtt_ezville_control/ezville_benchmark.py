@@ -0,0 +1,472 @@
+import asyncio
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import ezville
+
+# ezville.py 성능 측정용 스크립트
+#
+# intake: ezville.py를 mqtt mode로 띄우고 (MQTT Broker는 프로세스 안의 가짜 Client로 대체) 같은 ew11/recv 메시지 흐름을
+#         예전 방식(state_loop_delay마다 Queue를 비우는 Polling)과 현재 방식(수신 즉시 asyncio.Queue로 전달)으로 주입하여
+#         메시지 수신부터 바뀐 상태가 Publish될 때까지의 지연 p50/p99 비교
+# roundtrip: ezville_simulator.py를 띄우고 ezville.py (--target wallpad면 ../ezville_wallpad/ezville_wallpad.py)를 socket으로 연결한 뒤
+#            (MQTT Broker는 프로세스 안의 가짜 Client로 대체) HA 명령 주입부터 바뀐 상태가 Publish될 때까지의 지연,
+#            명령 재전송 횟수, 시뮬레이터의 충돌 횟수 출력
+# reset: 시뮬레이터의 가짜 EW11 Telnet / 웹 관리 페이지를 대상으로 ezville.py의 EW11 리셋 (로그인, 재시작 명령, timeout) 확인
+#
+# 사용 예: python ezville_benchmark.py intake --count 500 --interval 0.03 --delay 0.2
+#          python ezville_benchmark.py roundtrip --commands 30 --set bus_slot_mode=true
+#          python ezville_benchmark.py roundtrip --target wallpad --set rs485.retry_interval=100
+#          python ezville_benchmark.py reset
+
+
+# 측정용 EW11 수신 데이터 흐름: [(시작 후 전달 시각 (초), 데이터), ...]
+# 매 Chunk마다 1번 방 1번 조명 상태가 바뀌므로 Chunk 하나당 ezville/light_01_01/power/state Publish가 정확히 한번 일어남
+INTAKE_TOPIC = 'ezville/light_01_01/power/state'
+
+def synthetic_stream(count, interval, seed):
+    rng = random.Random(seed)
+    packets = [bytes.fromhex(ezville.checksum('F70E11810400{:02X}00010000'.format(i % 2))) for i in range(2)]
+
+    stream = []
+    t = 0
+    for i in range(count):
+        # EW11은 Bus 상황에 따라 불규칙한 간격으로 Chunk를 보냄
+        t += interval * rng.uniform(0.5, 1.5)
+        stream.append((t, packets[i % len(packets)]))
+    return stream
+
+
+# MQTT Thread 역할: 기록된 간격대로 deliver(payload) 호출
+def produce(stream, deliver):
+    start = time.monotonic()
+    for offset, payload in stream:
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        deliver(payload)
+
+
+def report(name, latency):
+    samples = sorted(latency)
+    print('{:<8} {:>6}건  p50 {:7.2f}ms  p99 {:7.2f}ms  max {:7.2f}ms'.format(
+        name, len(samples), ezville.percentile(samples, 50) * 1000, ezville.percentile(samples, 99) * 1000, (samples[-1] if samples else 0) * 1000))
+
+
+# 실제 ezville_loop를 mqtt mode로 띄우고 ew11/recv 메시지를 주입, 각 메시지의 수신 시각(msg.timestamp)부터
+# 해당 상태가 Publish될 때까지의 지연 측정 (ezville_loop는 끝나지 않으므로 모드별로 별도 Process에서 실행)
+def intake(args):
+    if args.mode is None:
+        for mode in ('polled', 'queued'):
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), 'intake', '--mode', mode, '--count', str(args.count),
+                                     '--interval', str(args.interval), '--delay', str(args.delay), '--seed', str(args.seed)],
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+            lines = [line for line in result.stdout.splitlines() if line.startswith(mode) or line.startswith('[INFO] 수신') or line.startswith('[ERROR]')]
+            print('\n'.join(lines if mode == 'polled' else lines[1:]))
+        return
+
+    stream = synthetic_stream(args.count, args.interval, args.seed)
+    print('[INFO] 수신 데이터 {}건, {:.1f}초 분량, 예전 방식 state_loop_delay {}초'.format(len(stream), stream[-1][0] if stream else 0, args.delay))
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as file:
+        config = json.load(file)['options']
+    config.update({'mode': 'mqtt', 'reboot_control': False, 'state_snapshot_period': 0, 'ew11_capture_file': '',
+                   'metrics_mode': 'off', 'force_update_mode': False, 'DEBUG_LOG': False, 'MQTT_LOG': False, 'EW11_LOG': False})
+
+    client_class = PolledMqttClient if args.mode == 'polled' else FakeMqttClient
+    client_class.delay = args.delay
+    ezville.mqtt.Client = client_class
+    threading.Thread(target=intake_driver, args=(args, stream), daemon=True).start()
+    ezville.ezville_loop(config)
+
+
+def intake_driver(args, stream):
+    while FakeMqttClient.instance is None:
+        time.sleep(0.1)
+    client = FakeMqttClient.instance
+    client.start_drain()
+
+    # 첫 상태 (및 장치 등록)는 측정에서 제외
+    warmup = bytes.fromhex(ezville.checksum('F70E118104000100010000'))
+    sent = time.monotonic()
+    client.deliver(ezville.EW11_TOPIC + '/recv', warmup)
+    if client.wait_for(INTAKE_TOPIC, b'ON', sent, 10) is None:
+        print('[ERROR] ezville_loop가 시작되지 않았습니다')
+        os._exit(1)
+    time.sleep(0.5)
+
+    received = []
+    def deliver(payload):
+        received.append(client.deliver(ezville.EW11_TOPIC + '/recv', payload).timestamp)
+    client.history[INTAKE_TOPIC] = []
+    produce(stream, deliver)
+
+    # 메시지 하나당 Publish 하나이므로 순서대로 짝지음
+    deadline = time.monotonic() + args.delay + 5
+    while len(client.history[INTAKE_TOPIC]) < len(received) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    published = client.history[INTAKE_TOPIC]
+    if len(published) != len(received):
+        print('[ERROR] 메시지 {}건 중 Publish {}건'.format(len(received), len(published)))
+    report(args.mode, [done - timestamp for timestamp, done in zip(received, published)])
+
+    sys.stdout.flush()
+    os._exit(0)
+
+
+# MQTT Broker 대신 사용: Publish를 기록하고, Subscribe한 topic이면 on_message로 되돌려줌
+class FakeMqttClient:
+    instance = None
+
+    # ezville.py는 CallbackAPIVersion.VERSION2, ezville_wallpad.py는 예전 (VERSION1) Callback 형식 사용
+    def __init__(self, *args, **kwargs):
+        self.version2 = bool(args) and args[0] == mqtt.CallbackAPIVersion.VERSION2
+        self.on_connect = self.on_disconnect = self.on_message = None
+        self.subscriptions = []
+        self.cond = threading.Condition()
+        self.published = {}     # topic: (publish 시각, payload)
+        self.history = {}       # topic: [publish 시각, ...] (등록한 topic만 기록)
+        FakeMqttClient.instance = self
+
+    def username_pw_set(self, *args):
+        pass
+
+    def connect_async(self, *args, **kwargs):
+        pass
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    # Broker 연결 및 HA Birth Message를 바로 흉내냄
+    def loop_start(self):
+        if self.version2:
+            self.on_connect(self, None, None, 0, None)
+        else:
+            self.on_connect(self, None, None, 0)
+        self.deliver('homeassistant/status', b'online', retain=True)
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.extend(topic if isinstance(topic, list) else [(topic, qos)])
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self.cond:
+            self.published[topic] = (time.monotonic(), payload)
+            if topic in self.history:
+                self.history[topic].append(self.published[topic][0])
+            self.cond.notify_all()
+        if any(mqtt.topic_matches_sub(sub, topic) for sub, _ in self.subscriptions):
+            self.deliver(topic, payload, retain)
+
+    def deliver(self, topic, payload, retain=False):
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        msg.retain = retain
+        msg.timestamp = time.monotonic()
+        self.on_message(self, None, msg)
+        return msg
+
+    # PolledMqttClient용 (바로 전달하는 경우에는 할 일 없음)
+    def start_drain(self):
+        pass
+
+    # topic이 since 이후 value로 Publish될 때까지 대기, 그 시각 반환 (timeout이면 None)
+    def wait_for(self, topic, value, since, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                published = self.published.get(topic)
+                if published and published[0] >= since and published[1] == value:
+                    return published[0]
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    return None
+                self.cond.wait(remain)
+
+
+# 예전 방식 흉내: MQTT Thread가 받은 메시지를 Queue에만 쌓아두고 delay초마다 한꺼번에 처리 쪽으로 넘김
+# (수신 시각은 받은 시점에 기록하므로 Queue에서 기다린 시간이 그대로 지연에 포함됨)
+class PolledMqttClient(FakeMqttClient):
+    delay = 0.2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = queue.Queue()
+
+    def deliver(self, topic, payload, retain=False):
+        if topic != ezville.EW11_TOPIC + '/recv':
+            return super().deliver(topic, payload, retain)
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        msg.retain = retain
+        msg.timestamp = time.monotonic()
+        self.pending.put(msg)
+        return msg
+
+    def start_drain(self):
+        def drain():
+            while True:
+                while not self.pending.empty():
+                    self.on_message(self, None, self.pending.get())
+                time.sleep(self.delay)
+        threading.Thread(target=drain, daemon=True).start()
+
+
+def free_port():
+    with socket.socket() as soc:
+        soc.bind(('127.0.0.1', 0))
+        return soc.getsockname()[1]
+
+
+# 명령을 하나씩 주입하고 결과 출력 후 종료 (ezville_loop / serial_async_loop는 끝나지 않으므로 별도 Thread에서 실행)
+# state_topics: 조명별 상태 topic (command topic은 끝의 state를 command로 바꾼 것), summary: 측정 대상의 재전송 통계 문자열
+def roundtrip_driver(args, simulator, simulator_stats, state_topics, summary):
+    while FakeMqttClient.instance is None:
+        time.sleep(0.1)
+    client = FakeMqttClient.instance
+
+    # 모든 조명 상태가 등록될 때까지 대기
+    deadline = time.monotonic() + 30
+    while not all(topic in client.published for topic in state_topics):
+        if time.monotonic() > deadline:
+            print('[ERROR] 조명 상태가 등록되지 않았습니다')
+            os._exit(1)
+        time.sleep(0.1)
+    time.sleep(args.gap)
+
+    latency = []
+    failed = 0
+    for i in range(args.commands):
+        topic = state_topics[i % len(state_topics)]
+        value = b'OFF' if client.published[topic][1] == b'ON' else b'ON'
+
+        sent = time.monotonic()
+        client.deliver(topic[:-len('state')] + 'command', value)
+        done = client.wait_for(topic, value, sent, args.timeout)
+        if done is None:
+            failed += 1
+        else:
+            latency.append(done - sent)
+        time.sleep(args.gap)
+
+    report('roundtrip', latency)
+    print('명령 {}건 (실패 {}), {}'.format(args.commands, failed, summary()))
+    print('시뮬레이터: {}'.format(simulator_stats[-1] if simulator_stats else '-'))
+
+    simulator.terminate()
+    sys.stdout.flush()
+    os._exit(0)
+
+
+# --set KEY=VALUE 반영 (ezville_wallpad처럼 설정이 나뉘어 있으면 rs485.retry_interval=100 처럼 지정)
+def apply_overrides(config, items):
+    for item in items:
+        key, value = item.split('=', 1)
+        target = config
+        *sections, key = key.split('.')
+        for section in sections:
+            target = target[section]
+        try:
+            target[key] = json.loads(value)
+        except ValueError:
+            target[key] = value
+
+
+def roundtrip(args):
+    port = free_port()
+    simulator = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ezville_simulator.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--rooms', str(args.rooms), '--lights', str(args.lights),
+         '--collision-rate', str(args.collision_rate), '--noise-rate', str(args.noise_rate),
+         '--stats-period', '1', '--seed', str(args.seed)] + args.simulator_args,
+        stdout=subprocess.PIPE, universal_newlines=True)
+
+    # 시뮬레이터 출력은 마지막 통계만 보관
+    simulator_stats = []
+    def read_simulator():
+        for line in simulator.stdout:
+            if '충돌' in line:
+                simulator_stats.append(line.strip())
+    threading.Thread(target=read_simulator, daemon=True).start()
+    time.sleep(0.5)
+
+    random.seed(args.seed)
+    try:
+        if args.target == 'wallpad':
+            roundtrip_wallpad(args, port, simulator, simulator_stats)
+        else:
+            roundtrip_ezville(args, port, simulator, simulator_stats)
+    finally:
+        simulator.terminate()
+
+
+def roundtrip_ezville(args, port, simulator, simulator_stats):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as file:
+        config = json.load(file)['options']
+    config.update({'mode': 'socket', 'ew11_server': '127.0.0.1', 'ew11_port': port,
+                   'reboot_control': False, 'state_snapshot_period': 0, 'ew11_capture_file': '',
+                   'metrics_mode': 'mqtt', 'metrics_period': args.metrics_period})
+    apply_overrides(config, args.set)
+
+    # 마지막 통계가 전달될 때까지 대기 후 재전송 통계 출력
+    def summary():
+        time.sleep(max(args.metrics_period, 1) + 0.5)
+        metrics = json.loads(FakeMqttClient.instance.published[ezville.METRICS_TOPIC][1])
+        return '재전송 {}, 완료 {}, ACK 평균 지연 {}초'.format(metrics['command_retries'], metrics['commands'], metrics['ack_latency_avg'])
+
+    state_topics = ['ezville/light_{:0>2d}_{:0>2d}/power/state'.format(room, light)
+                    for room in range(1, args.rooms + 1) for light in range(1, args.lights + 1)]
+
+    ezville.mqtt.Client = FakeMqttClient
+    threading.Thread(target=roundtrip_driver, args=(args, simulator, simulator_stats, state_topics, summary), daemon=True).start()
+    ezville.ezville_loop(config)
+
+
+# ezville_wallpad.py는 설정과 연결을 Module 전역 변수로 들고 있으므로 __main__과 같은 순서로 직접 채워서 실행
+def roundtrip_wallpad(args, port, simulator, simulator_stats):
+    wallpad_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ezville_wallpad')
+    sys.path.insert(0, wallpad_dir)
+    import ezville_wallpad
+
+    with open(os.path.join(wallpad_dir, 'config.json')) as file:
+        options = json.load(file)['options']
+    options['serial_mode'] = 'socket'
+    options['socket'].update({'address': '127.0.0.1', 'port': port})
+    options['log']['to_file'] = False
+    options['rs485']['dump_time'] = 0
+    apply_overrides(options, args.set)
+    options['mqtt']['_discovery'] = options['mqtt']['discovery']
+
+    def summary():
+        return '명령 Queue {}'.format(ezville_wallpad.serial_queue.stats())
+
+    prefix = options['mqtt']['prefix']
+    state_topics = ['{}/light/1_{}_{}/power/state'.format(prefix, room, light)
+                    for room in range(1, args.rooms + 1) for light in range(1, args.lights + 1)]
+
+    ezville_wallpad.init_logger()
+    ezville_wallpad.Options = options
+    ezville_wallpad.mqtt = FakeMqttClient()
+    ezville_wallpad.conn = ezville_wallpad.EzVilleSocket()
+    ezville_wallpad.start_mqtt_loop()
+
+    threading.Thread(target=roundtrip_driver, args=(args, simulator, simulator_stats, state_topics, summary), daemon=True).start()
+    if options['rs485']['engine'] == 'asyncio':
+        ezville_wallpad.serial_async_loop()
+    else:
+        ezville_wallpad.serial_loop()
+
+
+# 시뮬레이터를 Telnet / 웹 관리 페이지 포트와 함께 띄우고, 재시작 로그 줄 수를 셀 수 있도록 출력을 모아둠
+def start_admin_simulator(extra_args):
+    telnet_port, http_port = free_port(), free_port()
+    simulator = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ezville_simulator.py'),
+         '--host', '127.0.0.1', '--port', str(free_port()), '--telnet-port', str(telnet_port), '--http-port', str(http_port),
+         '--stats-period', '60'] + extra_args,
+        stdout=subprocess.PIPE, universal_newlines=True)
+
+    restarts = []
+    def read_simulator():
+        for line in simulator.stdout:
+            if 'EW11 재시작' in line:
+                restarts.append(line.strip())
+    threading.Thread(target=read_simulator, daemon=True).start()
+    time.sleep(0.5)
+    return simulator, telnet_port, http_port, restarts
+
+
+# 리셋 결과가 기대와 같은지 출력 (expected: None이면 성공, 아니면 발생해야 하는 예외)
+async def check_reset(name, reset, expected, restarts):
+    before = len(restarts)
+    try:
+        await reset
+        result = None
+    except (OSError, asyncio.TimeoutError) as e:
+        result = e
+    await asyncio.sleep(0.2)
+    restarted = len(restarts) > before
+
+    if expected is None:
+        ok = result is None and restarted
+    else:
+        ok = isinstance(result, expected) and not restarted
+    print('{:<4} {:<28} {}  ({}, 재시작 {})'.format('OK' if ok else 'FAIL', name, 'expected ' + ('success' if expected is None else expected.__name__),
+                                                 'success' if result is None else repr(result), 'O' if restarted else 'X'))
+    return ok
+
+
+def reset(args):
+    path = '/restart.html'
+    results = []
+
+    simulator, telnet_port, http_port, restarts = start_admin_simulator(
+        ['--ew11-user', 'admin', '--ew11-password', 'secret', '--restart-path', path, '--restart-time', '0.1'])
+    try:
+        results.append(asyncio.run(check_reset('telnet', ezville.reset_ew11_telnet('127.0.0.1', 'admin', 'secret', args.timeout, port=telnet_port), None, restarts)))
+        results.append(asyncio.run(check_reset('telnet wrong password', ezville.reset_ew11_telnet('127.0.0.1', 'admin', 'wrong', args.timeout, port=telnet_port), asyncio.TimeoutError, restarts)))
+        results.append(asyncio.run(check_reset('http', ezville.reset_ew11_http('127.0.0.1', 'admin', 'secret', path, args.timeout, port=http_port), None, restarts)))
+        results.append(asyncio.run(check_reset('http wrong password', ezville.reset_ew11_http('127.0.0.1', 'admin', 'wrong', path, args.timeout, port=http_port), ConnectionError, restarts)))
+        results.append(asyncio.run(check_reset('http wrong path', ezville.reset_ew11_http('127.0.0.1', 'admin', 'secret', '/nothing', args.timeout, port=http_port), ConnectionError, restarts)))
+    finally:
+        simulator.terminate()
+
+    # 접속만 받고 응답하지 않는 EW11
+    simulator, telnet_port, http_port, restarts = start_admin_simulator(['--admin-hang'])
+    try:
+        results.append(asyncio.run(check_reset('telnet no response', ezville.reset_ew11_telnet('127.0.0.1', 'admin', 'admin', args.timeout, port=telnet_port), asyncio.TimeoutError, restarts)))
+        results.append(asyncio.run(check_reset('http no response', ezville.reset_ew11_http('127.0.0.1', 'admin', 'admin', path, args.timeout, port=http_port), asyncio.TimeoutError, restarts)))
+    finally:
+        simulator.terminate()
+
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ezville.py 성능 측정')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parser_intake = commands.add_parser('intake', help='ezville.py 메시지 수신~Publish 지연 비교 (Polling vs Queue)')
+    parser_intake.add_argument('--mode', choices=['polled', 'queued'], help='한 가지 방식만 측정 (없으면 두 방식을 각각 별도 Process로 측정)')
+    parser_intake.add_argument('--count', type=int, default=500, help='합성 데이터 Chunk 수')
+    parser_intake.add_argument('--interval', type=float, default=0.03, help='합성 데이터 평균 Chunk 간격 (초)')
+    parser_intake.add_argument('--delay', type=float, default=0.2, help='예전 방식의 state_loop_delay (초)')
+    parser_intake.add_argument('--seed', type=int, default=1, help='합성 데이터 난수 Seed')
+    parser_intake.set_defaults(func=intake)
+
+    parser_roundtrip = commands.add_parser('roundtrip', help='시뮬레이터 대상 명령 왕복 지연 및 재전송 측정 (ezville.py / ezville_wallpad.py)')
+    parser_roundtrip.add_argument('--target', choices=['ezville', 'wallpad'], default='ezville', help='측정 대상 (ezville.py 혹은 ezville_wallpad.py)')
+    parser_roundtrip.add_argument('--commands', type=int, default=20, help='주입할 조명 명령 수')
+    parser_roundtrip.add_argument('--gap', type=float, default=0.5, help='명령 사이 간격 (초)')
+    parser_roundtrip.add_argument('--timeout', type=float, default=15, help='명령별 상태 반영 대기 시간 (초)')
+    parser_roundtrip.add_argument('--rooms', type=int, default=2, help='시뮬레이터 방 갯수')
+    parser_roundtrip.add_argument('--lights', type=int, default=3, help='시뮬레이터 방별 조명 갯수')
+    parser_roundtrip.add_argument('--collision-rate', type=float, default=0, help='시뮬레이터 충돌 확률')
+    parser_roundtrip.add_argument('--noise-rate', type=float, default=0, help='시뮬레이터 Checksum 오류 확률')
+    parser_roundtrip.add_argument('--metrics-period', type=float, default=1, help='ezville.py 통계 전달 주기 (초)')
+    parser_roundtrip.add_argument('--seed', type=int, default=1, help='난수 Seed')
+    parser_roundtrip.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='측정 대상 설정 변경 (예: bus_slot_mode=true, wallpad는 rs485.retry_interval=100)')
+    parser_roundtrip.add_argument('--simulator-args', nargs=argparse.REMAINDER, default=[], help='시뮬레이터에 그대로 넘길 나머지 인자')
+    parser_roundtrip.set_defaults(func=roundtrip)
+
+    parser_reset = commands.add_parser('reset', help='가짜 EW11 Telnet / 웹 관리 페이지 대상 리셋 확인')
+    parser_reset.add_argument('--timeout', type=float, default=1, help='ew11_reset_timeout (초)')
+    parser_reset.set_defaults(func=reset)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,405 @@
+import asyncio
+import argparse
+import base64
+import random
+import time
+
+# EzVille 월패드 + EW11 시뮬레이터
+# EW11처럼 TCP 포트를 열고, 월패드의 장치별 상태 요구(Polling)와 장치의 상태 응답을 RS485 속도에 맞춰 흘려보냄
+# 접속한 클라이언트(ezville.py / ezville_wallpad.py의 socket mode)가 보낸 명령은 Bus에 실린 것으로 보고 장치 상태를 바꾼 뒤 ACK 응답
+# 다른 패킷 전송 중에 명령이 들어오면 충돌로 처리하여 무시하고, 설정에 따라 일부러 충돌이나 Checksum 오류를 섞음
+# --telnet-port / --http-port를 지정하면 EW11 리셋용 Telnet 로그인 및 웹 관리 페이지 재시작도 흉내냄 (재시작 시 RS485 연결을 끊음)
+#
+# 사용 예: python ezville_simulator.py --port 8899 --collision-rate 0.05 --noise-rate 0.01
+#          python ezville_simulator.py --port 8899 --telnet-port 2323 --http-port 8080
+
+
+# CHECKSUM 및 ADD를 붙여 패킷 완성
+def make_packet(data):
+    xor = 0
+    for b in data:
+        xor ^= b
+    return bytes(data) + bytes([xor, (sum(data) + xor) & 0xFF])
+
+def verify_packet(packet):
+    xor = 0
+    for b in packet[:-2]:
+        xor ^= b
+    return packet[-2] == xor and packet[-1] == sum(packet[:-1]) & 0xFF
+
+
+# 장치 상태 (월패드가 Polling하는 순서대로 생성)
+class Light:
+    def __init__(self, room, count):
+        self.id, self.group = 0x0E, 0x10 | room
+        self.power = [random.randint(0, 1) for _ in range(count)]
+
+    def data(self):
+        return [0x00] + self.power
+
+    # [조명 번호] [상태] [00]
+    def command(self, cmd, data):
+        if cmd == 0x41 and 1 <= data[0] <= len(self.power):
+            self.power[data[0] - 1] = data[1] & 0x01
+            return 0xC1, self.group
+
+
+class Thermostat:
+    def __init__(self, count):
+        self.id, self.group = 0x36, 0x1F
+        self.heat = [random.randint(0, 1) for _ in range(count)]
+        self.away = [0] * count
+        self.set_temp = [random.randint(20, 25) for _ in range(count)]
+        self.cur_temp = [random.randint(18, 26) for _ in range(count)]
+
+    def data(self):
+        heat = sum(bit << i for i, bit in enumerate(self.heat))
+        away = sum(bit << i for i, bit in enumerate(self.away))
+        temps = []
+        for set_temp, cur_temp in zip(self.set_temp, self.cur_temp):
+            temps += [set_temp, cur_temp]
+        return [0x80, heat, away, 0x00, 0x00] + temps
+
+    # 명령은 방별 그룹 (1번 그룹 1-5)으로 들어옴
+    def command(self, cmd, data, room):
+        if not 1 <= room <= len(self.heat):
+            return
+        if cmd == 0x43:
+            self.heat[room - 1] = data[0] & 0x01
+            self.away[room - 1] = 0
+        elif cmd == 0x44:
+            self.set_temp[room - 1] = data[0] & 0x7F
+        elif cmd == 0x45:
+            self.away[room - 1] = data[0] & 0x01
+            self.heat[room - 1] = 0
+        else:
+            return
+        return cmd | 0x80, 0x10 | room
+
+    # 현재 온도는 설정 온도 쪽으로 천천히 변함
+    def drift(self):
+        for i, heat in enumerate(self.heat):
+            if random.random() < 0.05:
+                target = self.set_temp[i] if heat else 18
+                self.cur_temp[i] += (target > self.cur_temp[i]) - (target < self.cur_temp[i])
+
+
+class Plug:
+    def __init__(self, room, count):
+        self.id, self.group = 0x50, 0x10 | room
+        self.power = [1] * count
+        self.auto = [0] * count
+        self.current = [random.randint(0, 5000) for _ in range(count)]
+
+    # [plug 갯수] [상위 4 BIT 자동모드 / 하위 4 BIT On/Off] [전력량 2 Byte] ...
+    def data(self):
+        data = [len(self.power)]
+        for power, auto, current in zip(self.power, self.auto, self.current):
+            data += [auto << 4 | power, current >> 8, current & 0xFF]
+        return data
+
+    # [plug 번호] [상태]
+    def command(self, cmd, data):
+        if cmd == 0x43 and 1 <= data[0] <= len(self.power):
+            self.power[data[0] - 1] = data[1] & 0x01
+            return 0xC3, self.group
+
+    # 전력량은 켜져 있는 동안 조금씩 흔들림
+    def drift(self):
+        for i, power in enumerate(self.power):
+            self.current[i] = max(0, min(0xFFFF, self.current[i] + random.randint(-30, 30))) if power else 0
+
+
+class GasValve:
+    def __init__(self):
+        self.id, self.group = 0x12, 0x01
+        self.open = 1
+
+    def data(self):
+        return [0x00, self.open, 0x00]
+
+    # 잠그기만 가능
+    def command(self, cmd, data):
+        if cmd == 0x41:
+            self.open = 0
+            return 0xC1, 0x11
+
+
+class Batch:
+    def __init__(self):
+        self.id, self.group = 0x33, 0x01
+        self.states = 0x00
+
+    def data(self):
+        return [0x00, self.states, 0x00]
+
+    # 애드온이 일괄차단기 상태 패킷을 직접 보내는 방식이므로 그대로 반영 (월패드 ACK는 없음)
+    def command(self, cmd, data):
+        if cmd == 0x81:
+            self.states = data[1]
+            return None, self.group
+
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+
+        # 9600bps, 8N1 기준 1 Byte 전송 시간
+        self.byte_time = 10 / args.baud
+
+        self.lights = [Light(room, args.lights) for room in range(1, args.rooms + 1)]
+        self.thermostat = Thermostat(args.rooms)
+        self.plugs = [Plug(room, args.plugs) for room in range(1, args.rooms + 1)]
+        self.gasvalve = GasValve()
+        self.batch = Batch()
+
+        self.devices = self.lights + [self.thermostat] + self.plugs + [self.gasvalve, self.batch]
+
+        # 접속한 클라이언트 및 Bus 점유 상태
+        self.clients = set()
+        self.bus = asyncio.Lock()
+        self.busy_until = 0
+
+        # 처리 대기 중인 ACK [(시각, 패킷)]
+        self.pending_ack = []
+
+        # EW11 재시작 중에는 (down_until까지) Polling 및 RS485 접속을 멈춤
+        self.down_until = 0
+
+        self.stats = {'frames': 0, 'commands': 0, 'collisions': 0, 'injected': 0, 'noise': 0, 'invalid': 0, 'restarts': 0}
+
+    # 패킷을 Bus에 싣기 - 전송 시간 동안 Bus 점유 (noise_rate 확률로 Byte 하나를 깨뜨림)
+    async def transmit(self, packet):
+        async with self.bus:
+            if random.random() < self.args.noise_rate:
+                packet = bytearray(packet)
+                packet[random.randrange(1, len(packet))] ^= 1 << random.randrange(8)
+                self.stats['noise'] += 1
+
+            # 클라이언트 명령이 Bus를 쓰고 있으면 끝날 때까지 대기
+            wait = self.busy_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            # EW11처럼 Bus에서 패킷을 다 받은 뒤에 클라이언트로 전달
+            duration = len(packet) * self.byte_time
+            self.busy_until = time.monotonic() + duration
+            await asyncio.sleep(duration)
+            for writer in list(self.clients):
+                writer.write(packet)
+            self.stats['frames'] += 1
+
+    # 월패드 Polling 순서대로 상태 요구 -> 장치 응답 반복, 사이사이 대기 중인 ACK 전송
+    async def poll_loop(self):
+        while True:
+            for device in self.devices:
+                wait = self.down_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self.flush_ack()
+
+                await self.transmit(make_packet([0xF7, device.id, device.group, 0x01, 0x00]))
+                await asyncio.sleep(self.args.response_delay)
+                await self.transmit(make_packet([0xF7, device.id, device.group, 0x81, len(device.data())] + device.data()))
+                await asyncio.sleep(self.args.poll_gap)
+
+            self.thermostat.drift()
+            for plug in self.plugs:
+                plug.drift()
+
+    # 장치 응답 지연이 지난 ACK 전송
+    async def flush_ack(self):
+        while self.pending_ack and self.pending_ack[0][0] <= time.monotonic():
+            await self.transmit(self.pending_ack.pop(0)[1])
+
+    # 클라이언트가 보낸 패킷 처리 - 전송 중인 패킷과 겹치거나 collision_rate 확률에 걸리면 충돌로 무시
+    def receive(self, packet):
+        if not verify_packet(packet):
+            self.stats['invalid'] += 1
+            return
+        now = time.monotonic()
+        if now < self.busy_until:
+            self.stats['collisions'] += 1
+            return
+        self.busy_until = now + len(packet) * self.byte_time
+        if random.random() < self.args.collision_rate:
+            self.stats['injected'] += 1
+            return
+
+        id, group, cmd, data = packet[1], packet[2], packet[3], packet[5:-2]
+        
+        # 온도조절기는 전체 그룹 하나로 응답하고, 가스밸브 / 일괄차단기는 하나 뿐이라 그룹 구분 없음
+        if id == 0x36:
+            result = self.thermostat.command(cmd, data, group & 0x0F)
+            device = self.thermostat
+        else:
+            device = next((device for device in self.devices if device.id == id and (device.group & 0x0F == group & 0x0F or id in (0x12, 0x33))), None)
+            result = device.command(cmd, data) if device else None
+        if result is None:
+            return
+
+        self.stats['commands'] += 1
+        ack, ack_group = result
+        if ack is not None:
+            ack_packet = make_packet([0xF7, id, ack_group, ack, len(device.data())] + device.data())
+            self.pending_ack.append((time.monotonic() + self.args.response_delay, ack_packet))
+
+    async def handle_client(self, reader, writer):
+        if time.monotonic() < self.down_until:
+            writer.close()
+            return
+        self.clients.add(writer)
+        print('[INFO] 클라이언트 접속: {}'.format(writer.get_extra_info('peername')))
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(256)
+                if not data:
+                    break
+                buffer += data
+
+                # F7로 시작하는 완성된 패킷만 처리하고 나머지는 다음 수신 때 이어서 처리
+                while True:
+                    k = buffer.find(0xF7)
+                    if k < 0:
+                        buffer.clear()
+                        break
+                    del buffer[:k]
+                    if len(buffer) < 5 or len(buffer) < 7 + buffer[4]:
+                        break
+                    length = 7 + buffer[4]
+                    self.receive(bytes(buffer[:length]))
+                    del buffer[:length]
+        except OSError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+            print('[INFO] 클라이언트 접속 종료')
+
+    # EW11 재시작: RS485 연결을 모두 끊고 restart_time초 동안 응답하지 않음
+    def restart(self):
+        self.stats['restarts'] += 1
+        self.down_until = time.monotonic() + self.args.restart_time
+        self.pending_ack.clear()
+        for writer in list(self.clients):
+            writer.close()
+        print('[INFO] EW11 재시작 ({}초)'.format(self.args.restart_time))
+
+    # Telnet 한 줄 읽기 (클라이언트의 옵션 협상 응답 IAC xx yy는 제거)
+    async def telnet_readline(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError
+        while 255 in line:
+            k = line.index(255)
+            end = k + (3 if line[k + 1:k + 2] and line[k + 1] >= 251 else 2)
+            line = line[:k] + line[end:]
+        return line.strip().decode('utf-8', 'replace')
+
+    # EW11 Telnet: 옵션 협상 (WILL ECHO, WILL SGA) 후 login: / password: 를 물어보고, 로그인되면 Restart 명령을 받아 재시작
+    # admin_hang이면 접속만 받고 아무 응답도 하지 않음 (리셋 timeout 확인용)
+    async def handle_telnet(self, reader, writer):
+        try:
+            if self.args.admin_hang:
+                await reader.read()
+                return
+            writer.write(bytes([255, 251, 1, 255, 251, 3]) + b'\r\nEW11 login: ')
+            while True:
+                user = await self.telnet_readline(reader)
+                writer.write(b'password: ')
+                password = await self.telnet_readline(reader)
+                if (user, password) == (self.args.ew11_user, self.args.ew11_password):
+                    break
+                writer.write(b'\r\nLogin incorrect\r\nEW11 login: ')
+            writer.write(b'\r\nWelcome\r\n# ')
+            while True:
+                line = await self.telnet_readline(reader)
+                if line == 'Restart':
+                    writer.write(b'Restart..\r\n')
+                    await writer.drain()
+                    self.restart()
+                    return
+                writer.write(b'Unknown command\r\n# ')
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    # EW11 웹 관리 페이지: Basic 인증이 맞고 restart_path로 요청하면 200 응답 후 재시작
+    async def handle_http(self, reader, writer):
+        try:
+            if self.args.admin_hang:
+                await reader.read()
+                return
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            path = lines[0].split()[1] if len(lines[0].split()) > 1 else ''
+            auth = 'Basic ' + base64.b64encode('{}:{}'.format(self.args.ew11_user, self.args.ew11_password).encode('utf-8')).decode('ascii')
+            if not any(line.lower().startswith('authorization:') and line.split(':', 1)[1].strip() == auth for line in lines[1:]):
+                writer.write(b'HTTP/1.0 401 Unauthorized\r\nWWW-Authenticate: Basic realm="EW11"\r\n\r\n')
+            elif path != self.args.restart_path:
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n')
+                await writer.drain()
+                self.restart()
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def stats_loop(self):
+        last = dict(self.stats)
+        while True:
+            await asyncio.sleep(self.args.stats_period)
+            rate = (self.stats['frames'] - last['frames']) / self.args.stats_period
+            print('[INFO] 패킷 {:.1f}개/초, 명령 {}, 충돌 {} (주입 {}), Checksum 오류 주입 {}, 잘못된 수신 {}, 재시작 {}'.format(
+                rate, self.stats['commands'], self.stats['collisions'], self.stats['injected'], self.stats['noise'], self.stats['invalid'], self.stats['restarts']))
+            last = dict(self.stats)
+
+
+async def main(args):
+    simulator = Simulator(args)
+    server = await asyncio.start_server(simulator.handle_client, args.host, args.port)
+    print('[INFO] EzVille 시뮬레이터 시작: {}:{}'.format(args.host, args.port))
+
+    if args.telnet_port:
+        await asyncio.start_server(simulator.handle_telnet, args.host, args.telnet_port)
+        print('[INFO] EW11 Telnet 시작: {}:{}'.format(args.host, args.telnet_port))
+    if args.http_port:
+        await asyncio.start_server(simulator.handle_http, args.host, args.http_port)
+        print('[INFO] EW11 웹 관리 페이지 시작: {}:{}'.format(args.host, args.http_port))
+
+    asyncio.ensure_future(simulator.poll_loop())
+    asyncio.ensure_future(simulator.stats_loop())
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EzVille 월패드 / EW11 시뮬레이터')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--baud', type=int, default=9600, help='RS485 통신 속도')
+    parser.add_argument('--rooms', type=int, default=3, help='방 갯수 (방별 조명/대기전력 및 온도조절기 수)')
+    parser.add_argument('--lights', type=int, default=3, help='방별 조명 갯수')
+    parser.add_argument('--plugs', type=int, default=2, help='방별 대기전력 콘센트 갯수')
+    parser.add_argument('--response-delay', type=float, default=0.01, help='상태 요구 / 명령 후 장치가 응답하기까지의 시간 (초)')
+    parser.add_argument('--poll-gap', type=float, default=0.02, help='장치 응답 후 다음 상태 요구까지의 빈 구간 (초)')
+    parser.add_argument('--collision-rate', type=float, default=0, help='Bus가 비어 있어도 명령을 충돌로 버릴 확률')
+    parser.add_argument('--noise-rate', type=float, default=0, help='전송 패킷의 Byte 하나를 깨뜨릴 확률')
+    parser.add_argument('--stats-period', type=float, default=10, help='통계 출력 주기 (초)')
+    parser.add_argument('--seed', type=int, help='난수 Seed (재현용)')
+    parser.add_argument('--telnet-port', type=int, help='EW11 Telnet 포트 (지정 시에만 열림, 실제 EW11은 23)')
+    parser.add_argument('--http-port', type=int, help='EW11 웹 관리 페이지 포트 (지정 시에만 열림, 실제 EW11은 80)')
+    parser.add_argument('--ew11-user', default='admin', help='EW11 Telnet / 웹 관리 페이지 ID')
+    parser.add_argument('--ew11-password', default='admin', help='EW11 Telnet / 웹 관리 페이지 비밀번호')
+    parser.add_argument('--restart-path', default='/restart.html', help='웹 관리 페이지의 재시작 주소')
+    parser.add_argument('--restart-time', type=float, default=1, help='재시작 후 RS485 연결을 다시 받기까지의 시간 (초)')
+    parser.add_argument('--admin-hang', action='store_true', help='Telnet / 웹 관리 페이지가 접속만 받고 응답하지 않음 (리셋 timeout 확인용)')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.get_event_loop().run_until_complete(main(args))
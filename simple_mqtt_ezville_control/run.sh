@@ -5,4 +5,5 @@ PY_FILE="ezville.py"
 # start server
 echo "[Info] Start simple_mqtt_ezville_control"
 
-python -u /$PY_FILE
+# 애드온 종료 신호(SIGTERM)를 python이 직접 받도록 exec로 실행
+exec python -u /$PY_FILE